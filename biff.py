@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Minimal BIFF8 (.xls) reader
+
+    Reads only records the converter needs: shared strings, XF and
+    STYLE records of workbook globals and cells of column B and of
+    criteria columns of worksheets. Book and Sheet mimic the part of
+    xlrd interface used to compile workbooks. Anything unusual
+    (encryption, older BIFF versions, formulas in used columns, ...)
+    raises Unsupported, so caller can fall back to xlrd.
+
+    Run as script to compare it with xlrd on given files:
+        python biff.py file.xls ...
+"""
+
+import mmap
+import sys
+from struct import error as struct_error, unpack
+
+from xlrd import compdoc
+from xlrd.biffh import unpack_unicode
+from xlrd.book import unpack_SST_table
+from xlrd.sheet import unpack_RK
+
+
+class Unsupported(Exception):
+    pass
+
+
+XL_BOF = 0x0809
+XL_EOF = 0x000A
+XL_FILEPASS = 0x002F
+XL_CONTINUE = 0x003C
+XL_BOUNDSHEET = 0x0085
+XL_SST = 0x00FC
+XL_XF = 0x00E0
+XL_STYLE = 0x0293
+
+XL_LABELSST = 0x00FD
+XL_LABEL = 0x0204
+XL_RSTRING = 0x00D6
+XL_NUMBER = 0x0203
+XL_RK = 0x027E
+XL_MULRK = 0x00BD
+XL_BLANK = 0x0201
+XL_MULBLANK = 0x00BE
+XL_BOOLERR = 0x0205
+XL_FORMULA = (0x0006, 0x0206, 0x0406)
+XL_MERGEDCELLS = 0x00E5
+
+BIFF8 = 0x0600
+BOF_GLOBALS = 0x0005
+BOF_WORKSHEET = 0x0010
+BOUNDSHEET_WORKSHEET = 0
+
+# Column with requirement text, criteria columns follow it
+TEXT_COLUMN = 1
+
+
+def records(mem, position: int):
+    """ yield (code, data) of records starting at position up to EOF """
+    end = len(mem)
+    while position + 4 <= end:
+        code, length = unpack('<HH', mem[position:position + 4])
+        data = mem[position + 4:position + 4 + length]
+        position += 4 + length
+        yield code, data
+        if code == XL_EOF:
+            return
+    raise Unsupported('Unexpected end of stream')
+
+
+class XF(object):
+
+    __slots__ = ('is_style', 'parent_style_index')
+
+    def __init__(self, data: bytes):
+        flags = unpack('<H', data[4:6])[0]
+        self.is_style = bool(flags & 0x0004)
+        self.parent_style_index = flags >> 4
+
+
+class Cell(object):
+
+    __slots__ = ('value', 'xf_index')
+
+    def __init__(self, value, xf_index: int):
+        self.value = value
+        self.xf_index = xf_index
+
+
+EMPTY = Cell('', 0)
+
+
+class Row(object):
+
+    __slots__ = ('cells',)
+
+    def __init__(self, cells: dict):
+        self.cells = cells
+
+    def __getitem__(self, column: int) -> Cell:
+        return self.cells.get(column, EMPTY)
+
+
+class Sheet(object):
+    """ Cells of text and criteria columns of a worksheet
+
+        nrows and ncols are counted over all cells, as xlrd does.
+        Sheets of header_only book keep header row only and reading
+        stops when other rows begin, nrows and ncols count header row.
+    """
+
+    def __init__(self, book, name: str, position: int):
+        self.name = name
+        self.nrows = 0
+        self.ncols = 0
+        self.rows = dict()
+        self.header = None
+        self.header_only = book.header_only
+        self.read(book, position)
+
+    def cell(self, row: int, column: int) -> Cell:
+        return self.row(row)[column]
+
+    def row(self, row: int) -> Row:
+        return Row(self.rows.get(row, {}))
+
+    def columns(self) -> set:
+        """ return columns to keep: text column and criteria columns from header """
+        if self.header is None:
+            header = self.rows.get(0, {})
+            self.header = {TEXT_COLUMN}
+            column = TEXT_COLUMN + 1
+            while True:
+                value = header.get(column, EMPTY).value
+                if not isinstance(value, str):
+                    raise Unsupported('Criteria name is not a string')
+                if value.strip() == '':
+                    break
+                self.header.add(column)
+                column += 1
+        return self.header
+
+    def put(self, row: int, column: int, value, xf_index: int):
+        if row >= self.nrows:
+            self.nrows = row + 1
+        if column >= self.ncols:
+            self.ncols = column + 1
+        if row == 0:
+            if self.header is not None:
+                raise Unsupported('Header row cell after other rows')
+        elif self.header_only or column not in self.columns():
+            return
+        self.rows.setdefault(row, {})[column] = Cell(value, xf_index)
+
+    def read(self, book, position: int):
+        strings = book.strings
+        stream = records(book.mem, position)
+        code, data = next(stream)
+        if code != XL_BOF or unpack('<HH', data[:4]) != (BIFF8, BOF_WORKSHEET):
+            raise Unsupported('Not a BIFF8 worksheet')
+        try:
+            for code, data in stream:
+                if self.header_only and self.nrows > 1:
+                    break
+                if code == XL_LABELSST:
+                    row, column, xf_index, index = unpack('<HHHi', data[:10])
+                    self.put(row, column, strings[index], xf_index)
+                elif code == XL_NUMBER:
+                    row, column, xf_index, value = unpack('<HHHd', data[:14])
+                    self.put(row, column, value, xf_index)
+                elif code == XL_RK:
+                    row, column, xf_index = unpack('<HHH', data[:6])
+                    self.put(row, column, unpack_RK(data[6:10]), xf_index)
+                elif code == XL_MULRK:
+                    row, first = unpack('<HH', data[:4])
+                    for n in range((len(data) - 6) // 6):
+                        position = 4 + n * 6
+                        xf_index = unpack('<H', data[position:position + 2])[0]
+                        self.put(row, first + n, unpack_RK(data[position + 2:position + 6]),
+                                 xf_index)
+                elif code in (XL_LABEL, XL_RSTRING):
+                    row, column, xf_index = unpack('<HHH', data[:6])
+                    self.put(row, column, unpack_unicode(data, 6, lenlen=2), xf_index)
+                elif code == XL_BLANK:
+                    row, column, xf_index = unpack('<HHH', data[:6])
+                    self.put(row, column, '', xf_index)
+                elif code == XL_MULBLANK:
+                    row, first = unpack('<HH', data[:4])
+                    for n in range((len(data) - 6) // 2):
+                        xf_index = unpack('<H', data[4 + n * 2:6 + n * 2])[0]
+                        self.put(row, first + n, '', xf_index)
+                elif code == XL_BOOLERR:
+                    row, column, xf_index, value = unpack('<HHHB', data[:7])
+                    self.put(row, column, value, xf_index)
+                elif code in XL_FORMULA:
+                    row, column = unpack('<HH', data[:4])
+                    if column == TEXT_COLUMN or row == 0 or column in self.columns():
+                        raise Unsupported('Formula in used column')
+                    self.put(row, column, None, 0)
+                elif code == XL_MERGEDCELLS:
+                    count = unpack('<H', data[:2])[0]
+                    for n in range(count):
+                        first_row, last_row, first_column, last_column = \
+                            unpack('<HHHH', data[2 + n * 8:10 + n * 8])
+                        self.nrows = max(self.nrows, last_row + 1)
+                        self.ncols = max(self.ncols, last_column + 1)
+                elif code == XL_BOF:
+                    raise Unsupported('Embedded substream')
+        except (struct_error, IndexError) as e:
+            # Record shorter than its fields or index out of table
+            raise Unsupported('Malformed record 0x{:04X}: {}'.format(code, e))
+
+
+class Book(object):
+    """ Workbook globals: shared strings, XF and STYLE records and worksheets
+
+        header_only book reads header rows of sheets only, see Sheet
+    """
+
+    sheet_class = Sheet
+    map = None
+
+    def __init__(self, file_name: str, header_only: bool=False):
+        self.header_only = header_only
+        # File is memory-mapped: pages are read as records are scanned
+        # and are not kept in process memory when workbook is released
+        with open(file_name, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError) as e:
+                # Empty files and some special files can not be mapped
+                raise Unsupported(str(e))
+        self.strings = []
+        self.xf_list = []
+        self.style_name_map = dict()
+        self.sheet_list = []
+        self.loaded = dict()
+        try:
+            self.mem, self.base = self.workbook_stream(self.map)
+            self.read_globals()
+        except BaseException:
+            self.release_resources()
+            raise
+        self.nsheets = len(self.sheet_list)
+
+    @staticmethod
+    def workbook_stream(content) -> tuple:
+        """ return (stream content, stream start) of Workbook stream """
+        if content[:8] != compdoc.SIGNATURE:
+            raise Unsupported('Not an OLE2 compound document')
+        try:
+            document = compdoc.CompDoc(content, logfile=sys.stdout)
+            for stream_name in ('Workbook', 'Book'):
+                mem, base, _ = document.locate_named_stream(stream_name)
+                if mem:
+                    return mem, base
+        except compdoc.CompDocError as e:
+            raise Unsupported(str(e))
+        raise Unsupported('No workbook stream')
+
+    def read_globals(self):
+        stream = records(self.mem, self.base)
+        code, data = next(stream)
+        if code != XL_BOF or unpack('<HH', data[:4]) != (BIFF8, BOF_GLOBALS):
+            raise Unsupported('Not a BIFF8 workbook')
+        sst = None
+        try:
+            for code, data in stream:
+                if code == XL_CONTINUE and sst is not None:
+                    sst.append(data)
+                    continue
+                if sst is not None:
+                    self.strings = unpack_SST_table(sst, unpack('<i', sst[0][4:8])[0])[0]
+                    sst = None
+                if code == XL_FILEPASS:
+                    raise Unsupported('Encrypted workbook')
+                elif code == XL_SST:
+                    sst = [data]
+                elif code == XL_XF:
+                    self.xf_list.append(XF(data))
+                elif code == XL_STYLE:
+                    flag_and_xfx = unpack('<H', data[:2])[0]
+                    if not flag_and_xfx & 0x8000:
+                        name = unpack_unicode(data, 2, lenlen=2)
+                        self.style_name_map[name] = (0, flag_and_xfx & 0x0fff)
+                elif code == XL_BOUNDSHEET:
+                    position, visibility, sheet_type = unpack('<iBB', data[:6])
+                    if sheet_type == BOUNDSHEET_WORKSHEET:
+                        self.sheet_list.append((unpack_unicode(data, 6, lenlen=1),
+                                                position + self.base))
+        except (struct_error, IndexError) as e:
+            # Record shorter than its fields or index out of table
+            raise Unsupported('Malformed record 0x{:04X}: {}'.format(code, e))
+
+    def sheet_by_index(self, index: int) -> Sheet:
+        if index not in self.loaded:
+            name, position = self.sheet_list[index]
+            self.loaded[index] = self.sheet_class(self, name, position)
+        return self.loaded[index]
+
+    def unload_sheet(self, index: int):
+        self.loaded.pop(index, None)
+
+    def release_resources(self):
+        self.mem = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.strings = None
+        self.loaded = dict()
+
+
+def open_workbook(file_name: str, header_only: bool=False) -> Book:
+    return Book(file_name, header_only)
+
+
+def benchmark(file_names: list):
+    """ compile every file with both readers, print times and whether results match """
+    from time import time
+    import xtow
+
+    def signature(book):
+        return [(sheet.name, sheet.criteria, sheet.flags, sheet.texts,
+                 list(sheet.kinds), list(sheet.levels)) for sheet in book.sheets]
+
+    for file_name in file_names:
+        results = []
+        for reader in xtow.workbook_readers:
+            start = time()
+            book = xtow.compile_workbook(file_name, reader)
+            results.append((reader, time() - start, signature(book)))
+        (_, xlrd_time, expected), (_, biff_time, got) = results
+        print('{}: xlrd {:.3f} sec, biff {:.3f} sec ({:.1f}x), {}'.format(
+            file_name, xlrd_time, biff_time, xlrd_time / biff_time,
+            'same' if got == expected else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
@@ -16,6 +16,12 @@ def build():
     os.chdir(os.path.dirname(sys.argv[0]))
     src = [
         'xtow.py',
+        'docxstream.py',
+        'cache.py',
+        'selection.py',
+        'biff.py',
+        'xlsx.py',
+        'rowstore.py',
         'gui.py',
         'build.py',
         'version.py',
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Persistent on-disk cache
+"""
+
+import os
+import hashlib
+import pickle
+from contextlib import suppress
+
+import config
+
+
+def content_hash(file_name: str) -> str:
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Cache(object):
+    """ Pickled objects in configuration folder
+
+        Entries are files named by key. Reading an entry updates its
+        modification time, so when total size exceeds max_size the least
+        recently used entries are removed first.
+        Cache errors never break conversion: unreadable entries are
+        treated as missing and failed writes are ignored.
+    """
+
+    suffix = '.pickle'
+
+    def __init__(self, name: str, max_size: int):
+        self.folder = os.path.join(config.folder(), 'cache', name)
+        self.max_size = max_size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key + self.suffix)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            with suppress(OSError):
+                os.remove(path)
+            return None
+        with suppress(OSError):
+            os.utime(path)
+        return value
+
+    def put(self, key: str, value):
+        path = self.path(key)
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(temp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except OSError:
+            with suppress(OSError):
+                os.remove(temp)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with suppress(OSError):
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with suppress(OSError):
+                os.remove(path)
+            total -= size
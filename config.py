@@ -36,6 +36,10 @@ with suppress(FileExistsError):
 __data = defaultdict(str)
 
 
+def folder():
+    return __folder
+
+
 def load():
     global __data
     try:
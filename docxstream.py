@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Streaming DOCX writer
+"""
+
+import time
+import zipfile
+
+from lxml import etree
+
+from docx.oxml.ns import qn
+from docx.opc.packuri import CONTENT_TYPES_URI
+from docx.opc.packuri import PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+
+
+# Earliest time zip format can store
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def zip_entry(name: str, date_time: tuple=None) -> zipfile.ZipInfo:
+    """ return ZipInfo for name, fixed date_time makes archive reproducible
+
+        date_time before ZIP_EPOCH (e.g. SOURCE_DATE_EPOCH=0) is clamped to it
+    """
+    if date_time is None:
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o600 << 16
+    else:
+        info = zipfile.ZipInfo(name, max(tuple(date_time), ZIP_EPOCH))
+        info.create_system = 0
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+class DocxStream(object):
+    """ Write word/document.xml of doc to file_name incrementally
+
+        Completed body elements are serialized into the zip as soon as
+        flush() is called and removed from the document DOM, so memory
+        does not grow with the number of paragraphs or table rows.
+        Table that is still growing is written row by row and closed
+        when something else follows it in the body.
+        Parts following the document part (styles, numbering, settings,
+        ...) are copied from doc on close(), so changes made to them
+        during conversion are preserved; parts preceding it (document
+        properties) are copied on open(). Entry order is the same as in
+        a regular save.
+        Zip entries get date_time if it is given, current time otherwise.
+    """
+
+    def __init__(self, doc, file_name, date_time: tuple=None):
+        self.doc = doc
+        self.file_name = file_name
+        self.date_time = date_time
+        self.zip = None
+        self.output = None
+        self.declarations = list()
+        self.table = None
+
+    @property
+    def body(self):
+        return self.doc.element.body
+
+    def parts(self):
+        return list(self.doc.part.package.iter_parts())
+
+    def open(self):
+        package = self.doc.part.package
+        document_part = self.doc.part
+        self.zip = zipfile.ZipFile(self.file_name, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.writestr(CONTENT_TYPES_URI.membername,
+                      _ContentTypesItem.from_parts(self.parts()).blob)
+        self.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        # Entries are in the order of a regular save: parts preceding
+        # document part now, document rels and the rest on close()
+        for part in self.parts():
+            if part is document_part:
+                break
+            self.write_part(part)
+
+        document = self.doc.element
+        # Every element is written without namespace declarations
+        # already made on w:document, as they are in a regular save
+        self.declarations = [
+            b' xmlns="%s"' % uri.encode() if prefix is None
+            else b' xmlns:%s="%s"' % (prefix.encode(), uri.encode())
+            for prefix, uri in document.nsmap.items()
+        ]
+        self.output = self.zip.open(zip_entry(document_part.partname.membername,
+                                              self.date_time), 'w')
+        self.output.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n")
+        self.output.write(etree.tostring(self.empty(document), encoding='UTF-8',
+                                         xml_declaration=False)[:-2] + b'>')
+        for child in document:
+            if child is not self.body:
+                self.write(child)
+        self.output.write(self.start_tag(self.body))
+
+    def writestr(self, name: str, data: bytes):
+        self.zip.writestr(zip_entry(name, self.date_time), data)
+
+    @staticmethod
+    def empty(element):
+        return etree.Element(element.tag, attrib=dict(element.attrib), nsmap=element.nsmap)
+
+    def serialize(self, element):
+        xml = etree.tostring(element, encoding='UTF-8', xml_declaration=False)
+        head, sep, tail = xml.partition(b'>')
+        for declaration in self.declarations:
+            head = head.replace(declaration, b'', 1)
+        return head + sep + tail
+
+    def write(self, element):
+        self.output.write(self.serialize(element))
+
+    def start_tag(self, element):
+        return self.serialize(self.empty(element))[:-2] + b'>'
+
+    @staticmethod
+    def end_tag(element):
+        return b'</%s:%s>' % (element.prefix.encode(),
+                               etree.QName(element).localname.encode())
+
+    def flush(self, table=None):
+        """ write out all complete body elements
+
+            table is the w:tbl that is still growing: its rows are written,
+            but the table itself remains open
+        """
+        body = self.body
+        for child in list(body):
+            if child.tag == qn('w:sectPr'):
+                continue
+            if child is table:
+                self.write_rows(child)
+                continue
+            if child is self.table:
+                self.close_table()
+                continue
+            self.close_table()
+            self.write(child)
+            body.remove(child)
+
+    def write_rows(self, tbl):
+        if tbl is not self.table:
+            self.close_table()
+            self.table = tbl
+            self.output.write(self.start_tag(tbl))
+            for child in tbl:
+                if child.tag != qn('w:tr'):
+                    self.write(child)
+        for tr in tbl.tr_lst:
+            self.write(tr)
+            tbl.remove(tr)
+
+    def close_table(self):
+        if self.table is None:
+            return
+        self.write_rows(self.table)
+        self.output.write(self.end_tag(self.table))
+        parent = self.table.getparent()
+        if parent is not None:
+            parent.remove(self.table)
+        self.table = None
+
+    def close(self):
+        self.flush()
+        self.close_table()
+        sectPr = self.body.find(qn('w:sectPr'))
+        if sectPr is not None:
+            self.write(sectPr)
+        self.output.write(self.end_tag(self.body))
+        self.output.write(self.end_tag(self.doc.element))
+        self.output.close()
+
+        document_part = self.doc.part
+        if len(document_part.rels):
+            self.writestr(document_part.partname.rels_uri.membername,
+                          document_part.rels.xml)
+        parts = self.parts()
+        for part in parts[parts.index(document_part) + 1:]:
+            self.write_part(part)
+        self.zip.close()
+
+    def write_part(self, part):
+        part.before_marshal()
+        self.writestr(part.partname.membername, part.blob)
+        if len(part.rels):
+            self.writestr(part.partname.rels_uri.membername, part.rels.xml)
@@ -6,6 +6,8 @@
 """
 import os
 import sys
+import multiprocessing
+import threading
 import time
 import re
 import traceback
@@ -68,6 +70,57 @@ MARGIN = (WLEFT - WLOGO) // 2
 
 DEFAULT_DESTINATION = 'no default'
 
+# Tk root is created when this module is imported and spawned worker
+# processes import it again, so GUI parses and renders in its own process
+JOBS = 1
+
+
+class Prefetch(object):
+    """ Read outlines and parse workbooks of sources on a background thread
+
+        Outlines are read first as they are needed by the very next phase.
+        Thread can not be stopped, so cancel() makes it quit before next
+        source and its results are dropped.
+    """
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.outlines = dict()
+        self.workbooks = dict()
+        self.outlines_done = threading.Event()
+        self.workbooks_done = threading.Event()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for path in self.sources:
+                if self.cancelled.is_set():
+                    return
+                self.outlines[SetupPhase.session_key(path)] = xtow.workbook_outline(path)
+            self.outlines_done.set()
+            for path in self.sources:
+                if self.cancelled.is_set():
+                    return
+                key = SetupPhase.session_key(path)
+                self.workbooks[key] = xtow.load_workbooks([path], jobs=JOBS)[0]
+        except Exception:
+            # Phase that needs failed source reads it again and shows the error
+            pass
+        finally:
+            self.outlines_done.set()
+            self.workbooks_done.set()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @staticmethod
+    def wait(done, root):
+        """ wait for done event keeping window responsive """
+        while not done.wait(0.05):
+            root.update()
+
 
 class SetupPhase(object):
     phases = list()
@@ -77,6 +130,12 @@ class SetupPhase(object):
         sheets=list()
     )
     last_conf = dict()
+    # Session cache of sources by (path, modification time): compiled
+    # workbooks and outlines, see session_books() and session_outlines()
+    workbooks = dict()
+    outlines = dict()
+    # Background parsing of sources, see start_prefetch()
+    prefetch = None
     root = tk.Tk()
     status_var = tk.StringVar()
     default_status = ''
@@ -482,6 +541,57 @@ class SetupPhase(object):
         file_name = '{}_{}_RFP_{}.docx'.format(prefix, name, today)
         return os.path.join(folder, file_name)
 
+    @staticmethod
+    def session_key(path):
+        return os.path.abspath(path), os.path.getmtime(path)
+
+    @classmethod
+    def start_prefetch(cls, sources):
+        """ start parsing sources in background unless it is running already """
+        prefetch = SetupPhase.prefetch
+        if prefetch is not None and set(prefetch.sources) == set(sources):
+            return
+        if prefetch is not None:
+            prefetch.cancel()
+        SetupPhase.prefetch = Prefetch(sources)
+
+    @classmethod
+    def take_prefetched(cls, workbooks):
+        """ wait for prefetch of current sources and move its results to session cache """
+        prefetch = SetupPhase.prefetch
+        if prefetch is None or set(prefetch.sources) != set(SetupPhase.conf['sources']):
+            return
+        prefetch.wait(prefetch.outlines_done, cls.root)
+        SetupPhase.outlines.update(prefetch.outlines)
+        if workbooks:
+            prefetch.wait(prefetch.workbooks_done, cls.root)
+            SetupPhase.workbooks.update(prefetch.workbooks)
+            SetupPhase.prefetch = None
+
+    @classmethod
+    def session_books(cls):
+        """ return compiled workbooks of sources, each parsed once per session """
+        cls.take_prefetched(workbooks=True)
+        sources = SetupPhase.conf['sources']
+        keys = [cls.session_key(path) for path in sources]
+        missing = [path for path, key in zip(sources, keys) if key not in SetupPhase.workbooks]
+        if missing:
+            for path, book in zip(missing, xtow.load_workbooks(missing, jobs=JOBS)):
+                SetupPhase.workbooks[cls.session_key(path)] = book
+        return [SetupPhase.workbooks[key] for key in keys]
+
+    @classmethod
+    def session_outlines(cls):
+        """ return xtow.workbook_outline() of sources, each read once per session """
+        cls.take_prefetched(workbooks=False)
+        result = []
+        for path in SetupPhase.conf['sources']:
+            key = cls.session_key(path)
+            if key not in SetupPhase.outlines:
+                SetupPhase.outlines[key] = xtow.workbook_outline(path)
+            result.append(SetupPhase.outlines[key])
+        return result
+
     @classmethod
     def open_workbook(cls, format=None):
         SetupPhase.conf['output_file_name'] = cls.output_file_name()
@@ -496,7 +606,10 @@ class SetupPhase(object):
             SetupPhase.conf['sources'],
             SetupPhase.conf['output_file_name'],
             criteria=SetupPhase.conf['options'],
-            sheets=SetupPhase.conf['sheets']
+            sheets=SetupPhase.conf['sheets'],
+            books=cls.session_books(),
+            # Prerendering in worker processes would block UI until done
+            jobs=JOBS
         )
 
     @classmethod
@@ -585,21 +698,28 @@ class SourcesPhase(SetupPhase):
             cls.set_status('Target folder does not exist')
             return False
         output = cls.output_file_name_for(cls.target_var.get(), cls.sources_list())
-        if os.path.exists(output):
+        # Outputs with manifest were generated here and are updated if stale
+        if os.path.exists(output) and xtow.read_manifest(output) is None:
             cls.set_status('Output file already exists')
             return False
         cls.set_status(cls.default_status)
+        # Sources are parsed while the user goes on to the next phases
+        cls.start_prefetch(cls.sources_list())
         return True
 
     @classmethod
     def decorate(cls):
-        cls.add_pick_files("Source Files", cls.sources_var, (("MS Excel file", "*.xls"),),
+        cls.add_pick_files("Source Files", cls.sources_var, (("MS Excel file", "*.xls *.xlsx"),),
                            tip='(Multiply files can be selected)')
         cls.add_pick_folder("Target Folder", cls.target_var)
 
     @classmethod
     def acquire_data(cls):
-        SetupPhase.conf['sources'] = [s.strip() for s in cls.sources_var.get().split(',')]
+        sources = [s.strip() for s in cls.sources_var.get().split(',')]
+        if set(sources) != set(SetupPhase.conf.get('sources', ())):
+            SetupPhase.workbooks.clear()
+            SetupPhase.outlines.clear()
+        SetupPhase.conf['sources'] = sources
         SetupPhase.conf['target_folder'] = cls.target_var.get()
 
     @classmethod
@@ -683,8 +803,7 @@ class SuitesPhase(SetupPhase):
 
     @classmethod
     def decorate(cls):
-        etow = cls.open_workbook()
-        full_list = etow.list_packages()
+        full_list = xtow.list_packages(SetupPhase.conf['sources'], cls.session_outlines())
 
         cls.add_title('Pick required product suites')
         cls.listbox = cls.add_listbox(full_list)
@@ -710,8 +829,7 @@ class SheetsPhase(SetupPhase):
 
     @classmethod
     def decorate(cls):
-        etow = cls.open_workbook()
-        sheets = etow.list_sheets()
+        sheets = xtow.list_sheets(SetupPhase.conf['sources'], cls.session_outlines())
         cls.add_title('Unpick unnecessary sheets')
         cls.sheets_listbox = cls.add_listbox(sheets)
         if SetupPhase.conf['sheets']:
@@ -806,10 +924,26 @@ class GeneratePhase(SetupPhase):
 
         cls.add_title("Processing")
 
+        output_file_name = cls.output_file_name()
+        SetupPhase.conf['output_file_name'] = output_file_name
+        manifest = xtow.conversion_manifest(SetupPhase.conf['format'],
+                                            SetupPhase.conf['sources'],
+                                            criteria=SetupPhase.conf['options'],
+                                            sheets=SetupPhase.conf['sheets'])
+        if xtow.up_to_date(output_file_name, manifest):
+            cls.add_message('Output file: %s' % os.path.basename(output_file_name))
+            cls.next_btn.config(state=tk.NORMAL)
+            cls.set_status('Output file is up to date with {} requirements. '
+                           'Press [{}] button to exit'.format(
+                               xtow.read_manifest(output_file_name)['requirements'],
+                               cls.next_button_label()))
+            return
+
         counter = xtow.Counter(SetupPhase.conf['sources'],
                                SetupPhase.conf['output_file_name'],
                                 criteria=SetupPhase.conf['options'],
-                                sheets=SetupPhase.conf['sheets'])
+                                sheets=SetupPhase.conf['sheets'],
+                                books=cls.session_books(), jobs=JOBS)
 
         lines = counter.count_scope_lines()
         print('lines', lines)
@@ -875,4 +1009,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Workbooks are parsed in worker processes, needed for frozen executable
+    multiprocessing.freeze_support()
     main()
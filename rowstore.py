@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Row store spilling to disk
+"""
+
+import mmap
+import pickle
+import tempfile
+
+
+class RowStore(object):
+    """ Compiled sheets kept in memory up to budget bytes
+
+        Sheets are appended in order and read back by index. Sheet size
+        is its pickled size. Once sheets kept in memory reach budget,
+        the rest are pickled into a temporary file that is memory-mapped
+        for reading, so spilled sheets cost memory only while they are
+        being rendered. The file is removed when the store is closed or
+        garbage collected.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.entries = []
+        self.kept_sheets = 0
+        self.kept_bytes = 0
+        self.spilled_sheets = 0
+        self.spilled_bytes = 0
+        self.file = None
+        self.map = None
+
+    def append(self, sheet) -> int:
+        """ store sheet, return its index """
+        data = pickle.dumps(sheet, pickle.HIGHEST_PROTOCOL)
+        if self.spilled_sheets == 0 and self.kept_bytes + len(data) <= self.budget:
+            self.entries.append(sheet)
+            self.kept_sheets += 1
+            self.kept_bytes += len(data)
+        else:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(prefix='extoword-', suffix='.rows')
+            self.entries.append((self.spilled_bytes, len(data)))
+            self.file.write(data)
+            self.spilled_sheets += 1
+            self.spilled_bytes += len(data)
+        return len(self.entries) - 1
+
+    def get(self, index: int):
+        entry = self.entries[index]
+        if not isinstance(entry, tuple):
+            return entry
+        offset, size = entry
+        if self.map is None or len(self.map) < offset + size:
+            self.remap()
+        return pickle.loads(self.map[offset:offset + size])
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def report(self) -> str:
+        mb = 1024 * 1024
+        return ('Row store: budget {:.1f} MB, {} sheets ({:.1f} MB) in memory, '
+                '{} sheets ({:.1f} MB) spilled to disk'.format(
+                    self.budget / mb, self.kept_sheets, self.kept_bytes / mb,
+                    self.spilled_sheets, self.spilled_bytes / mb))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Criteria selection expressions
+"""
+
+import re
+
+
+class Selection(object):
+    """ Boolean expression over criteria names
+
+        Grammar (operators are case insensitive, AND binds tighter than OR):
+            expression = term {OR term}
+            term = factor {AND factor}
+            factor = NOT factor | '(' expression ')' | name
+        Symbols '|', '&' and '!' may be used instead of OR, AND and NOT.
+        Name is a quoted string or a sequence of words that are not
+        operators, so 'Deep Discovery and not SPE' selects rows checked for
+        'Deep Discovery' but not for 'SPE'.
+        Expression is evaluated once per sheet on whole criteria columns,
+        so cost per row does not depend on expression size.
+    """
+
+    operators = {'or': '|', 'and': '&', 'not': '!'}
+    token_re = re.compile(r'\s*(?:([()|&!])|"([^"]*)"|\'([^\']*)\'|([^\s()|&!"\']+))')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = self.tokenize(text)
+        self.position = 0
+        self.tree = self.expression()
+        if self.position < len(self.tokens):
+            self.error('unexpected {!r}'.format(self.tokens[self.position][1]))
+        del self.tokens, self.position
+
+    @classmethod
+    def any_of(cls, names: list):
+        """ return selection of rows checked for any of names """
+        selection = cls.__new__(cls)
+        selection.text = ', '.join(names)
+        selection.tree = ('name', names[0])
+        for name in names[1:]:
+            selection.tree = ('or', selection.tree, ('name', name))
+        return selection
+
+    def error(self, message: str):
+        raise RuntimeError('Criteria "{}": {}'.format(self.text, message))
+
+    def tokenize(self, text: str) -> list:
+        """ return list of ('op', symbol) and ('name', name) tokens """
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = self.token_re.match(text, position)
+            if match is None:
+                self.error('unterminated quote')
+            position = match.end()
+            symbol, double, single, word = match.groups()
+            if symbol is not None:
+                tokens.append(('op', symbol))
+            elif word is not None and word.lower() in self.operators:
+                tokens.append(('op', self.operators[word.lower()]))
+            elif word is not None and tokens and tokens[-1][0] == 'word':
+                tokens[-1] = ('word', tokens[-1][1] + ' ' + word)
+            elif word is not None:
+                tokens.append(('word', word))
+            else:
+                tokens.append(('name', double if double is not None else single))
+        return [('name', value) if kind == 'word' else (kind, value)
+                for kind, value in tokens]
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def take(self, symbol: str) -> bool:
+        if self.peek() == ('op', symbol):
+            self.position += 1
+            return True
+        return False
+
+    def expression(self):
+        node = self.term()
+        while self.take('|'):
+            node = ('or', node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.take('&'):
+            node = ('and', node, self.factor())
+        return node
+
+    def factor(self):
+        if self.take('!'):
+            return ('not', self.factor())
+        if self.take('('):
+            node = self.expression()
+            if not self.take(')'):
+                self.error('missing )')
+            return node
+        kind, value = self.peek()
+        if kind != 'name':
+            self.error('name expected' if kind is None else 'unexpected {!r}'.format(value))
+        self.position += 1
+        return ('name', value)
+
+    def names(self) -> list:
+        """ return criteria names of expression in order of appearance """
+        result = []
+
+        def collect(node):
+            if node[0] == 'name':
+                if node[1] not in result:
+                    result.append(node[1])
+            else:
+                for child in node[1:]:
+                    collect(child)
+        collect(self.tree)
+        return result
+
+    def check(self, available: list):
+        """ raise error if expression uses criteria names not in available """
+        unknown = [name for name in self.names() if name not in available]
+        if unknown:
+            self.error('unknown criteria {}, available criteria are {}'.format(
+                ', '.join('"{}"'.format(name) for name in unknown),
+                ', '.join('"{}"'.format(name) for name in available) or 'none'))
+
+    def evaluate(self, column, everything):
+        """ return value of expression
+
+            column(name) returns set of rows checked for name and
+            everything is set of all rows, both either int bitsets or
+            NumPy boolean vectors
+        """
+        def value(node):
+            op = node[0]
+            if op == 'name':
+                return column(node[1])
+            if op == 'not':
+                return everything ^ value(node[1])
+            if op == 'and':
+                return value(node[1]) & value(node[2])
+            return value(node[1]) | value(node[2])
+        return value(self.tree)
+
+
+def parse(criteria, available: list=None):
+    """ return Selection for criteria or None to select all rows
+
+        criteria is either expression string or list of names any of
+        which should be checked. Names not in available criteria names
+        are an error, unless available is None.
+    """
+    if not criteria:
+        return None
+    if isinstance(criteria, str):
+        result = Selection(criteria)
+    else:
+        result = Selection.any_of(criteria)
+    if available is not None:
+        result.check(available)
+    return result
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# cython: language_level=3
+"""
+    Convert RFP from Excel to Word.
+
+    Read-only streaming .xlsx reader
+
+    Shared strings and sheets are parsed incrementally with iterparse,
+    parsed elements are dropped right away and only cells of column B
+    and of criteria columns are kept, so memory is bounded by one sheet's
+    used columns. Book and Sheet mimic the same part of xlrd interface
+    as biff module does, so workbooks are compiled the same way.
+"""
+
+import posixpath
+import re
+import zipfile
+
+from lxml import etree
+from xlrd.biffh import error_text_from_code
+
+import biff
+
+
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_PACKAGE_RELATIONSHIPS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_RELATIONSHIPS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+RT_OFFICE_DOCUMENT = NS_RELATIONSHIPS + '/officeDocument'
+RT_WORKSHEET = NS_RELATIONSHIPS + '/worksheet'
+RT_SHARED_STRINGS = NS_RELATIONSHIPS + '/sharedStrings'
+RT_STYLES = NS_RELATIONSHIPS + '/styles'
+
+
+def main(tag: str) -> str:
+    return '{%s}%s' % (NS_MAIN, tag)
+
+
+ROW = main('row')
+CELL = main('c')
+VALUE = main('v')
+TEXT = main('t')
+INLINE_STRING = main('is')
+PHONETIC_RUN = main('rPh')
+MERGE_CELL = main('mergeCell')
+SHARED_STRING = main('si')
+
+error_code_from_text = {text: code for code, text in error_text_from_code.items()}
+
+escaped_re = re.compile(r'_x([0-9A-Fa-f]{4})_')
+reference_re = re.compile(r'([A-Z]+)(\d+)')
+
+
+def unescape(text: str) -> str:
+    """ decode _xHHHH_ escapes of characters not allowed in XML """
+    if '_x' not in text:
+        return text
+    return escaped_re.sub(lambda match: chr(int(match.group(1), 16)), text)
+
+
+def string_text(element) -> str:
+    """ return text of si or is element without phonetic runs """
+    return unescape(''.join(t.text or '' for t in element.iter(TEXT)
+                            if t.getparent().tag != PHONETIC_RUN))
+
+
+def cell_position(reference: str) -> tuple:
+    """ return zero based (row, column) of reference like 'B12' """
+    match = reference_re.match(reference)
+    if match is None:
+        raise RuntimeError('Wrong cell reference {!r}'.format(reference))
+    letters, row = match.groups()
+    column = 0
+    for letter in letters:
+        column = column * 26 + ord(letter) - ord('A') + 1
+    return int(row) - 1, column - 1
+
+
+def release(element):
+    """ free parsed element and its already processed preceding siblings """
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+class XF(object):
+
+    __slots__ = ('is_style', 'parent_style_index')
+
+    def __init__(self, parent_style_index: int):
+        # Cell xf indexes and style xf indexes are separate in xlsx:
+        # cellXfs refer to cellStyleXfs that styles are defined for
+        self.is_style = False
+        self.parent_style_index = parent_style_index
+
+
+class Sheet(biff.Sheet):
+    """ Cells of text and criteria columns of a worksheet part """
+
+    def read(self, book, part: str):
+        strings = book.strings
+        row = -1
+        try:
+            with book.zip.open(part) as f:
+                for _, element in etree.iterparse(f, tag=(ROW, MERGE_CELL)):
+                    if element.tag == MERGE_CELL:
+                        last = element.get('ref').split(':')[-1]
+                        last_row, last_column = cell_position(last)
+                        self.nrows = max(self.nrows, last_row + 1)
+                        self.ncols = max(self.ncols, last_column + 1)
+                        continue
+                    row = int(element.get('r', row + 2)) - 1
+                    if self.header_only and row > 0:
+                        break
+                    column = -1
+                    for cell in element.iterchildren(CELL):
+                        reference = cell.get('r')
+                        if reference is None:
+                            column += 1
+                        else:
+                            row, column = cell_position(reference)
+                        self.put(row, column, self.value(cell, strings),
+                                 int(cell.get('s', 0)))
+                    release(element)
+        except biff.Unsupported as e:
+            raise RuntimeError('Sheet "{}": {}'.format(self.name, e))
+
+    @staticmethod
+    def value(cell, strings: list):
+        """ return cell value of the same type xlrd returns for .xls """
+        kind = cell.get('t', 'n')
+        if kind == 'inlineStr':
+            element = cell.find(INLINE_STRING)
+            return '' if element is None else string_text(element)
+        text = cell.findtext(VALUE)
+        if text is None:
+            return ''
+        if kind == 's':
+            return strings[int(text)]
+        if kind == 'n':
+            return float(text)
+        if kind == 'b':
+            return int(text)
+        if kind == 'e':
+            return error_code_from_text.get(text, 0)
+        return unescape(text)
+
+
+class Book(biff.Book):
+    """ Workbook part, shared strings and styles of .xlsx package """
+
+    sheet_class = Sheet
+
+    def __init__(self, file_name: str, header_only: bool=False):
+        self.header_only = header_only
+        self.zip = zipfile.ZipFile(file_name)
+        workbook = self.related('', RT_OFFICE_DOCUMENT)[0][1]
+        if workbook is None:
+            raise RuntimeError('{}: no workbook in package'.format(file_name))
+        relations = dict()
+        for rid, target, type in self.related(workbook):
+            relations[rid] = (target, type)
+        self.strings = list()
+        self.xf_list = list()
+        self.style_name_map = dict()
+        self.built_in_ids = dict()
+        for target, type in relations.values():
+            if type == RT_SHARED_STRINGS:
+                self.read_strings(target)
+            elif type == RT_STYLES and not header_only:
+                self.read_styles(target)
+        if not self.xf_list:
+            # Package without styles part: every cell has default format
+            self.xf_list.append(XF(0))
+        self.sheet_list = list()
+        root = etree.fromstring(self.zip.read(workbook))
+        for sheet in root.iter(main('sheet')):
+            target, type = relations.get(sheet.get('{%s}id' % NS_RELATIONSHIPS), (None, None))
+            if type == RT_WORKSHEET:
+                self.sheet_list.append((sheet.get('name'), target))
+        self.nsheets = len(self.sheet_list)
+        self.loaded = dict()
+
+    def related(self, part: str, type: str=None) -> list:
+        """ return [(id, target part, type)] of part relationships, of given type if any """
+        folder, name = posixpath.split(part)
+        rels = posixpath.join(folder, '_rels', name + '.rels')
+        try:
+            root = etree.fromstring(self.zip.read(rels))
+        except KeyError:
+            return [(None, None, None)]
+        result = []
+        for relationship in root.iter('{%s}Relationship' % NS_PACKAGE_RELATIONSHIPS):
+            if relationship.get('TargetMode') == 'External':
+                continue
+            target = relationship.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(folder, target))
+            if type is None or relationship.get('Type') == type:
+                result.append((relationship.get('Id'), target, relationship.get('Type')))
+        return result or [(None, None, None)]
+
+    def read_strings(self, part: str):
+        with self.zip.open(part) as f:
+            for _, element in etree.iterparse(f, tag=SHARED_STRING):
+                self.strings.append(string_text(element))
+                release(element)
+
+    def read_styles(self, part: str):
+        root = etree.fromstring(self.zip.read(part))
+        cell_xfs = root.find(main('cellXfs'))
+        if cell_xfs is not None:
+            for xf in cell_xfs.iterchildren(main('xf')):
+                self.xf_list.append(XF(int(xf.get('xfId', 0))))
+        cell_styles = root.find(main('cellStyles'))
+        if cell_styles is not None:
+            for style in cell_styles.iterchildren(main('cellStyle')):
+                xf_index = int(style.get('xfId', 0))
+                built_in_id = style.get('builtinId')
+                if built_in_id is not None:
+                    self.built_in_ids[xf_index] = int(built_in_id)
+                self.style_name_map[style.get('name')] = (built_in_id is not None, xf_index)
+
+    def release_resources(self):
+        self.zip.close()
+        self.strings = None
+        self.loaded = dict()
+
+
+def open_workbook(file_name: str, header_only: bool=False) -> Book:
+    return Book(file_name, header_only)
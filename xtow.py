@@ -7,21 +7,57 @@
 
 import sys
 import os
+import hashlib
+import json
+import re
+import multiprocessing
+import io
+import zipfile
+from array import array
 from contextlib import contextmanager
+from copy import deepcopy
+from datetime import date
+from datetime import datetime
+from datetime import timezone
 from itertools import cycle
+from itertools import islice
+from struct import unpack
 from time import time
-from time import strftime
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 import xlrd
+from lxml import etree
+try:
+    import numpy
+except ImportError:
+    # Criteria selection falls back to int bitsets
+    numpy = None
+import docx
 from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
 from docx.shared import Mm
 from docx.shared import Pt
 from docx.shared import RGBColor
 
 from docx.oxml import OxmlElement
+from docx.oxml import parse_xml
 from docx.oxml.ns import qn
+from docx.opc.part import XmlPart
+from docx.styles import BabelFish
 from docx.table import _Cell
 
+from docxstream import DocxStream
+from docxstream import zip_entry
+import cache
+import selection
+import biff
+import xlsx
+import rowstore
+
 
 def set_cell_border(cell: _Cell, **kwargs):
     tc = cell._tc
@@ -32,7 +68,10 @@ def set_cell_border(cell: _Cell, **kwargs):
     if tcBorders is None:
         tcBorders = OxmlElement('w:tcBorders')
         tcPr.append(tcBorders)
+    set_borders(tcBorders, **kwargs)
+
 
+def set_borders(tcBorders, **kwargs):
     # list over all available tags
     for edge in ('start', 'top', 'end', 'bottom', 'insideH', 'insideV'):
         edge_data = kwargs.get(edge)
@@ -82,6 +121,43 @@ def set_repeat_table_header(row):
     return row
 
 
+table_look_flags = {
+    'firstRow': 0x0020,
+    'lastRow': 0x0040,
+    'firstColumn': 0x0080,
+    'lastColumn': 0x0100,
+}
+
+
+def table_style(name, based_on=None, **conditions):
+    """ return w:style of table style
+
+        conditions map conditional formatting type (firstRow, lastCol, ...)
+        to cell borders in set_cell_border() format
+    """
+    style = OxmlElement('w:style')
+    style.set(qn('w:type'), 'table')
+    style.set(qn('w:customStyle'), '1')
+    style.set(qn('w:styleId'), name.replace(' ', ''))
+    style.name_val = name
+    if based_on is not None:
+        style.basedOn_val = based_on
+    for kind, borders in conditions.items():
+        tblStylePr = OxmlElement('w:tblStylePr')
+        tblStylePr.set(qn('w:type'), kind)
+        tcPr = OxmlElement('w:tcPr')
+        tcBorders = OxmlElement('w:tcBorders')
+        set_borders(tcBorders, **borders)
+        tcPr.append(tcBorders)
+        tblStylePr.append(tcPr)
+        style.append(tblStylePr)
+    return style
+
+
+def serialize(element):
+    return etree.tostring(element, encoding='UTF-8', xml_declaration=False)
+
+
 class Spin(object):
 
     minimal_iterval = 0.1
@@ -163,38 +239,75 @@ def spinner(style=0):
     s.cleanup()
 
 
-class CellStyle():
-    """
-        ...
-        'Heading 1': (0, 49), 'Heading 2': (0, 50), 'Heading 3': (0, 51),
-        'Heading 4': (0, 52), 'Input': (0, 53), 'Linked Cell': (0, 54),
-        ...
+# Heading styles by name, for workbooks that do not tell built-in style ids
+heading_style_names = {
+    'Heading 1': 0,
+    'Heading 2': 1,
+    'Heading 3': 2,
+    'Heading 4': 3,
+    'Заголовок 1': 0,
+    'Заголовок 2': 1,
+    'Заголовок 3': 2,
+    'Заголовок 4': 3,
+}
+
+# Built-in style ids of Heading 1 - Heading 4, the same in any Excel language
+built_in_headings = {16: 0, 17: 1, 18: 2, 19: 3}
+
+XL_EOF = 0x000A
+XL_STYLE = 0x0293
+XL_STYLEEXT = 0x0892
 
+NOT_HEADING = -1
+
+
+def built_in_styles(wb) -> dict:
+    """ return {style xf index: built-in style id} from workbook globals
+
+        Excel 2007 and later saves built-in styles as user-defined STYLE
+        records with localized names followed by STYLEEXT records that
+        keep built-in style id, xlrd ignores the latter. Workbook stream
+        has to be loaded, i.e. workbook opened with on_demand=True.
+        Styles of .xlsx workbooks keep built-in id as is.
     """
-    def __init__(self, wb):
-        self.wb = wb
-        self.mapping = {index: style_name for style_name, (_, index) in wb.style_name_map.items()}
-
-    def __call__(self, cell):
-        key = self.wb.xf_list[cell.xf_index].parent_style_index
-        return self.mapping[key]
-
-
-def map_style_to_heading_size(style: str) -> int:
-    style_to_heading_size_mapping = {
-        'Heading 1': 0,
-        'Heading 2': 1,
-        'Heading 3': 2,
-        'Heading 4': 3,
-        'Заголовок 1': 0,
-        'Заголовок 2': 1,
-        'Заголовок 3': 2,
-        'Заголовок 4': 3,
-    }
-    try:
-        return style_to_heading_size_mapping[style]
-    except KeyError:
-        return None
+    if isinstance(wb, xlsx.Book):
+        return wb.built_in_ids
+    result = dict()
+    mem = wb.mem
+    position = wb.base
+    style_xf_index = None
+    while position + 4 <= len(mem):
+        code, length = unpack('<HH', mem[position:position + 4])
+        data = mem[position + 4:position + 4 + length]
+        position += 4 + length
+        if code == XL_EOF:
+            break
+        if code == XL_STYLE and length >= 3:
+            flag_and_xfx, built_in_id = unpack('<HB', data[:3])
+            style_xf_index = flag_and_xfx & 0x0fff
+            if flag_and_xfx & 0x8000:
+                result[style_xf_index] = built_in_id
+            continue
+        if code == XL_STYLEEXT and style_xf_index is not None and length >= 15:
+            # FrtHeader (12 bytes), flags with fBuiltIn bit, category, built-in id
+            if data[12] & 1:
+                result[style_xf_index] = data[14]
+        style_xf_index = None
+    return result
+
+
+def heading_levels(wb) -> array:
+    """ return heading level (0 - Heading 1) or NOT_HEADING for every xf index """
+    style_levels = dict()
+    for name, (built_in, xf_index) in wb.style_name_map.items():
+        if name in heading_style_names:
+            style_levels[xf_index] = heading_style_names[name]
+    for xf_index, built_in_id in built_in_styles(wb).items():
+        style_levels[xf_index] = built_in_headings.get(built_in_id, NOT_HEADING)
+    return array('b', [
+        style_levels.get(n if xf.is_style else xf.parent_style_index, NOT_HEADING)
+        for n, xf in enumerate(wb.xf_list)
+    ])
 
 
 def text_and_list_style(text: str):
@@ -221,6 +334,413 @@ def item_depth(text: str):
         return text, 0
 
 
+def criteria_dict(sheet):
+    result = dict()
+    for n in range(2, sheet.ncols):
+        cell = sheet.cell(0, n)
+        value = cell.value.strip()
+        if value == '':
+            break
+        if value in result:
+            raise RuntimeError('Criteria names should be unique')
+        result[value] = n
+    return result
+
+
+def checked(value):
+    if isinstance(value, str):
+        return value.strip() != ''
+    elif isinstance(value, int):
+        return value != 0
+    elif isinstance(value, float):
+        return value != 0.0
+    else:
+        raise RuntimeError('{!r}: Wrond option cell type'.format(value))
+
+
+# Kinds of compiled rows
+KIND_EMPTY = 0
+KIND_HEADING = 1
+KIND_ITEM = 2
+KIND_ERROR = 3
+
+
+class CompiledSheet(object):
+    """ Rows of one sheet reduced to what converters need
+
+        texts, kinds and levels are columns indexed by row number (0 is
+        the row after criteria header). Level is heading size for
+        headings and list depth for items, text of items is stripped
+        of list marks and text of error rows is error message.
+        flags has int bitset of rows checked in every criteria column,
+        criteria maps criteria name to index in flags. With NumPy flags
+        are unpacked into boolean matrix of rows x criteria on first
+        selection; the matrix is not pickled.
+    """
+
+    __slots__ = ('file_name', 'name', 'criteria', 'flags', 'texts', 'kinds', 'levels',
+                 'matrix')
+
+    def __init__(self, file_name: str, name: str, criteria: dict, flags: list,
+                 texts: list, kinds: array, levels: array):
+        self.file_name = file_name
+        self.name = name
+        self.criteria = criteria
+        self.flags = flags
+        self.texts = texts
+        self.kinds = kinds
+        self.levels = levels
+        self.matrix = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'matrix'}
+
+    def __setstate__(self, state: dict):
+        self.matrix = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def nrows(self) -> int:
+        return len(self.kinds)
+
+    def suite_matrix(self):
+        """ return boolean NumPy matrix of rows x criteria """
+        if self.matrix is None:
+            size = (self.nrows + 7) // 8
+            packed = numpy.frombuffer(
+                b''.join(flag.to_bytes(size, 'little') for flag in self.flags),
+                dtype=numpy.uint8).reshape(len(self.flags), size)
+            self.matrix = numpy.unpackbits(packed, axis=1, count=self.nrows,
+                                           bitorder='little').T.astype(bool)
+        return self.matrix
+
+    def lines(self, expression) -> list:
+        """ return indexes of rows selected by expression (Selection), all rows for None """
+        if expression is None:
+            return list(range(self.nrows))
+        if numpy is None:
+            bits = expression.evaluate(
+                lambda name: self.flags[self.criteria[name]] if name in self.criteria else 0,
+                (1 << self.nrows) - 1)
+            return bit_indices(bits)
+        matrix = self.suite_matrix()
+        nothing = numpy.zeros(self.nrows, dtype=bool)
+        mask = expression.evaluate(
+            lambda name: matrix[:, self.criteria[name]] if name in self.criteria else nothing,
+            numpy.ones(self.nrows, dtype=bool))
+        return numpy.flatnonzero(mask).tolist()
+
+
+class CompiledWorkbook(object):
+
+    __slots__ = ('file_name', 'base_name', 'sheets')
+
+    def __init__(self, file_name: str, sheets: list):
+        self.file_name = sys.intern(file_name)
+        self.base_name = sys.intern(os.path.basename(file_name))
+        self.sheets = sheets
+
+
+def peak_memory():
+    """ return peak resident set size of this process in bytes, None if unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bitset(bits: bytearray) -> int:
+    return int.from_bytes(bits, 'little')
+
+
+def bit_indices(bits: int) -> list:
+    """ return indexes of set bits of int bitset """
+    digits = bin(bits)[:1:-1]
+    result = []
+    index = digits.find('1')
+    while index >= 0:
+        result.append(index)
+        index = digits.find('1', index + 1)
+    return result
+
+
+def compile_sheet(file_name: str, sheet, xf_levels: array) -> CompiledSheet:
+    """ xf_levels are heading levels by xf index, see heading_levels() """
+    columns = criteria_dict(sheet)
+    criteria = {name: n for n, name in enumerate(columns)}
+    columns = list(columns.values())
+    rows = sheet.nrows - 1
+    flags = [bytearray((rows + 7) // 8) for _ in columns]
+    texts = list()
+    kinds = array('b')
+    levels = array('b')
+    for line in range(1, sheet.nrows):
+        row = sheet.row(line)
+        n = line - 1
+        for bits, col in zip(flags, columns):
+            if checked(row[col].value):
+                bits[n >> 3] |= 1 << (n & 7)
+        cell = row[1]
+        kind, level = KIND_EMPTY, 0
+        try:
+            text = cell.value.strip()
+        except AttributeError:
+            kind, text = KIND_ERROR, f'Error on line {line+1} on sheet "{sheet.name}"'
+        if kind != KIND_ERROR and text != '':
+            heading = xf_levels[cell.xf_index]
+            if heading == NOT_HEADING:
+                kind = KIND_ITEM
+                text, level = item_depth(text)
+            else:
+                kind, level = KIND_HEADING, heading
+        texts.append(text)
+        kinds.append(kind)
+        levels.append(level)
+    return CompiledSheet(file_name, sys.intern(sheet.name), criteria,
+                         [bitset(bits) for bits in flags], texts, kinds, levels)
+
+
+workbook_readers = ('xlrd', 'biff')
+
+
+def compile_workbook(file_name: str, reader: str='biff') -> CompiledWorkbook:
+    """ parse workbook and reduce it to compiled sheets, see iter_compiled_sheets() """
+    return CompiledWorkbook(file_name, list(iter_compiled_sheets(file_name, reader)))
+
+
+def iter_compiled_sheets(file_name: str, reader: str='biff'):
+    """ parse workbook and yield its compiled sheets one by one
+
+        reader is one of workbook_readers: minimal BIFF reader is used
+        unless it meets something it does not support, xlrd otherwise.
+        Office Open XML (.xlsx) workbooks are always read by xlsx module.
+    """
+    if zipfile.is_zipfile(file_name):
+        yield from compile_sheets(file_name, xlsx.open_workbook(file_name))
+        return
+    done = 0
+    if reader == 'biff':
+        try:
+            for sheet in compile_sheets(file_name, biff.open_workbook(file_name)):
+                yield sheet
+                done += 1
+            return
+        except biff.Unsupported:
+            pass
+    wb = xlrd.open_workbook(file_name, formatting_info=True, on_demand=True)
+    yield from islice(compile_sheets(file_name, wb), done, None)
+
+
+def compile_sheets(file_name: str, wb):
+    """ yield compiled sheets of wb, each sheet is unloaded once compiled
+        and wb is released when sheets are exhausted
+    """
+    try:
+        xf_levels = heading_levels(wb)
+        file_name = sys.intern(file_name)
+        for index in range(1, wb.nsheets):
+            sheet = compile_sheet(file_name, wb.sheet_by_index(index), xf_levels)
+            wb.unload_sheet(index)
+            yield sheet
+    finally:
+        wb.release_resources()
+
+
+def sheet_headers(wb) -> list:
+    """ return [(sheet name, criteria names)] of sheets after the first one """
+    try:
+        result = []
+        for index in range(1, wb.nsheets):
+            sheet = wb.sheet_by_index(index)
+            result.append((sheet.name, list(criteria_dict(sheet))))
+            wb.unload_sheet(index)
+        return result
+    finally:
+        wb.release_resources()
+
+
+def workbook_outline(file_name: str) -> list:
+    """ return [(sheet name, criteria names)] of workbook
+
+        Only workbook directory and header row of every sheet are read,
+        without formatting, so it takes little time for any workbook size.
+    """
+    if zipfile.is_zipfile(file_name):
+        return sheet_headers(xlsx.open_workbook(file_name, header_only=True))
+    try:
+        return sheet_headers(biff.open_workbook(file_name, header_only=True))
+    except biff.Unsupported:
+        return sheet_headers(xlrd.open_workbook(file_name, on_demand=True))
+
+
+def list_packages(input_files: list, outlines: list=None) -> list:
+    """ return criteria names of input_files in order of appearance
+
+        outlines are workbook_outline() of input_files if they are known
+    """
+    if outlines is None:
+        outlines = [workbook_outline(file_name) for file_name in input_files]
+    result = dict()
+    for outline in outlines:
+        for sheet_name, criteria in outline:
+            result.update(dict.fromkeys(criteria))
+    return list(result)
+
+
+def list_sheets(input_files: list, outlines: list=None) -> list:
+    """ return sheet names of input_files, see list_packages() """
+    if outlines is None:
+        outlines = [workbook_outline(file_name) for file_name in input_files]
+    return [sheet_name for outline in outlines for sheet_name, criteria in outline]
+
+
+# Change when compiled workbook content or layout changes to invalidate cache
+COMPILER_VERSION = 3
+
+workbook_cache = cache.Cache('workbooks', max_size=256 * 1024 * 1024)
+
+
+def load_workbooks(input_files: list, use_cache: bool=True, jobs: int=None,
+                   lazy: bool=False, memory_budget: int=None) -> list:
+    """ return compiled workbooks in order of input_files
+
+        Workbooks are taken from disk cache if possible, cache key is
+        workbook content hash and COMPILER_VERSION, so renamed or copied
+        workbooks are found in cache too. The rest are parsed concurrently
+        by up to jobs worker processes (jobs=1 parses them one by one).
+        lazy returns LazyWorkbook objects instead, that keep no sheets
+        in memory. memory_budget returns StoredWorkbook objects which
+        sheets beyond memory_budget bytes are spilled to disk.
+    """
+    if lazy:
+        return [LazyWorkbook(file_name, use_cache) for file_name in input_files]
+    store = None if memory_budget is None else rowstore.RowStore(memory_budget)
+    keys = [None] * len(input_files)
+    books = [None] * len(input_files)
+
+    def add(n: int, sheets: list):
+        file_name = input_files[n]
+        for sheet in sheets:
+            sheet.file_name = file_name
+        if store is None:
+            books[n] = CompiledWorkbook(file_name, sheets)
+        else:
+            books[n] = StoredWorkbook(file_name, store,
+                                      [store.append(sheet) for sheet in sheets])
+
+    missing = []
+    for n, file_name in enumerate(input_files):
+        sheets = None
+        if use_cache:
+            keys[n] = '{}-v{}'.format(cache.content_hash(file_name), COMPILER_VERSION)
+            sheets = workbook_cache.get(keys[n])
+        if sheets is None:
+            missing.append(n)
+        else:
+            add(n, sheets)
+
+    def compiled(n: int, book: CompiledWorkbook):
+        if use_cache:
+            workbook_cache.put(keys[n], book.sheets)
+        add(n, book.sheets)
+
+    if jobs != 1 and len(missing) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Workbooks are stored as they arrive, not all at once
+                for n, book in zip(missing, executor.map(
+                        compile_workbook, [input_files[n] for n in missing])):
+                    compiled(n, book)
+        except (BrokenProcessPool, OSError):
+            pass
+    for n in missing:
+        if books[n] is None:
+            compiled(n, compile_workbook(input_files[n]))
+    return books
+
+
+class StoredWorkbook(object):
+    """ Compiled workbook which sheets are kept in RowStore """
+
+    __slots__ = ('file_name', 'base_name', 'store', 'indexes')
+
+    def __init__(self, file_name: str, store: rowstore.RowStore, indexes: list):
+        self.file_name = sys.intern(file_name)
+        self.base_name = sys.intern(os.path.basename(file_name))
+        self.store = store
+        self.indexes = indexes
+
+    @property
+    def sheets(self):
+        for index in self.indexes:
+            yield self.store.get(index)
+
+
+class LazyWorkbook(object):
+    """ Compiled workbook which sheets are loaded one at a time
+
+        Every iteration over sheets loads them one by one and drops each
+        sheet as soon as the next one is requested, so memory holds one
+        sheet at most. With use_cache compiled sheets are kept in workbook
+        cache one entry per sheet and the workbook is parsed only when
+        they are missing, otherwise it is parsed on every iteration.
+    """
+
+    __slots__ = ('file_name', 'base_name', 'key')
+
+    def __init__(self, file_name: str, use_cache: bool=True):
+        self.file_name = sys.intern(file_name)
+        self.base_name = sys.intern(os.path.basename(file_name))
+        self.key = None
+        if use_cache:
+            self.key = '{}-v{}-lazy'.format(cache.content_hash(file_name), COMPILER_VERSION)
+            if self.key not in workbook_cache:
+                self.store()
+                if self.key not in workbook_cache:
+                    # Cache is not writable, parse on every iteration
+                    self.key = None
+
+    def sheet_key(self, index: int) -> str:
+        return '{}-{}'.format(self.key, index)
+
+    def store(self) -> int:
+        """ compile sheets into cache, return number of sheets """
+        return sum(1 for _ in self.compile())
+
+    def compile(self):
+        """ yield compiled sheets putting them into cache """
+        count = 0
+        for index, sheet in enumerate(iter_compiled_sheets(self.file_name)):
+            workbook_cache.put(self.sheet_key(index), sheet)
+            count += 1
+            yield sheet
+        # Sheet count is put last, sheets are complete if it is present
+        workbook_cache.put(self.key, count)
+
+    @property
+    def sheets(self):
+        if self.key is None:
+            yield from iter_compiled_sheets(self.file_name)
+            return
+        count = workbook_cache.get(self.key)
+        if count is None:
+            # Cache is not writable or was cleared: compile in the same pass
+            yield from self.compile()
+            return
+        for index in range(count):
+            sheet = workbook_cache.get(self.sheet_key(index))
+            if sheet is None:
+                # Evicted from cache: parse the rest in one pass and refill it
+                yield from islice(self.compile(), index, None)
+                return
+            sheet.file_name = self.file_name
+            yield sheet
+
+
 def default_template():
     file_name = 'default.docx'
     if hasattr(sys, '_MEIPASS'):
@@ -229,38 +749,267 @@ def default_template():
         return None
 
 
+def template_path(template=None):
+    if template is None:
+        template = default_template()
+    if template is None:
+        template = os.path.join(os.path.dirname(docx.__file__), 'templates', 'default.docx')
+    return os.path.abspath(template)
+
+
+template_cache = dict()
+
+
+def load_template(template=None):
+    """ return copy of template document
+
+        Template package is parsed once per process for every path and
+        modification time, following calls get clones of parsed parts
+    """
+    path = template_path(template)
+    key = (path, os.path.getmtime(path))
+    try:
+        master = template_cache[key]
+    except KeyError:
+        for stale in [k for k in template_cache if k[0] == path]:
+            del template_cache[stale]
+        master = Document(path)
+        template_cache[key] = master
+    return clone_document(master)
+
+
+def clone_document(doc):
+    """ copy python-docx document by copying XML trees of its parts """
+    package = doc.part.package
+    clone_package = type(package)()
+    clones = dict()
+    for part in package.iter_parts():
+        if isinstance(part, XmlPart):
+            clone = type(part)(part.partname, part.content_type,
+                               deepcopy(part.element), clone_package)
+        else:
+            clone = type(part).load(part.partname, part.content_type,
+                                    part.blob, clone_package)
+        clones[part] = clone
+
+    def copy_rels(source, target):
+        for rel in source.rels.values():
+            if rel.is_external:
+                target.load_rel(rel.reltype, rel.target_ref, rel.rId, True)
+            else:
+                target.load_rel(rel.reltype, clones[rel.target_part], rel.rId)
+
+    copy_rels(package, clone_package)
+    for part, clone in clones.items():
+        copy_rels(part, clone)
+    clone_package.after_unmarshal()
+    return clone_package.main_document_part.document
+
+
+# Names of styles in templates made by localized MS Word
+localized_style_names = {
+    'Заголовок 1': 'Heading 1',
+    'Заголовок 2': 'Heading 2',
+    'Заголовок 3': 'Heading 3',
+    'Заголовок 4': 'Heading 4',
+    'Название': 'Title',
+    'Основной текст': 'Body Text',
+    'Маркированный список': 'List Bullet',
+    'Маркированный список 2': 'List Bullet 2',
+    'Маркированный список 3': 'List Bullet 3',
+    'Нумерованный список': 'List Number',
+    'Сетка таблицы': 'Table Grid',
+}
+
+
+class StyleTable(object):
+    """ Style name to styleId mapping built once per document
+
+        Looking style up by name in python-docx scans the whole styles
+        part, so converters resolve names through this table instead.
+        Default style of its type maps to None, as python-docx does.
+    """
+
+    def __init__(self, doc):
+        self.ids = dict()
+        for style in doc.styles.element.style_lst:
+            name = style.name_val
+            if name is None:
+                continue
+            style_id = None if style.default else style.styleId
+            self.ids.setdefault(name, style_id)
+            self.ids.setdefault(BabelFish.internal2ui(name), style_id)
+        for localized, name in localized_style_names.items():
+            if name in self.ids:
+                self.ids.setdefault(localized, self.ids[name])
+            elif localized in self.ids:
+                self.ids[name] = self.ids[localized]
+
+    def __getitem__(self, name):
+        if name is None:
+            return None
+        return self.ids[name]
+
+    def require(self, names):
+        missing = [name for name in names if name not in self.ids]
+        if missing:
+            raise RuntimeError('Template lacks required styles: {}'.format(
+                ', '.join(missing)))
+
+
+# Change when rendering of rows changes to invalidate cached fragments
+FRAGMENT_VERSION = 1
+
+fragment_cache = cache.Cache('fragments', max_size=256 * 1024 * 1024)
+
+
+def save_reproducible(doc, file_name: str, date_time: tuple):
+    """ save document with date_time on every zip entry """
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    with zipfile.ZipFile(buffer) as source, \
+            zipfile.ZipFile(file_name, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            target.writestr(zip_entry(info.filename, date_time), source.read(info))
+
+
+# Converter options that do not change output
+runtime_options = ('stream', 'use_cache', 'jobs', 'lazy', 'memory_budget')
+
+
+def manifest_file_name(file_name_docx: str) -> str:
+    name, ext = os.path.splitext(file_name_docx)
+    return '{}_manifest.json'.format(name)
+
+
+def conversion_manifest(format: str, input_files: list, criteria: list=(),
+                        sheets: list=(), template: str=None, **options) -> dict:
+    """ return description of everything output of conversion depends on
+
+        Inputs and template are identified by content hash, sources are
+        kept in order. options are converter keyword arguments.
+    """
+    manifest = dict(
+        version=[COMPILER_VERSION, FRAGMENT_VERSION],
+        format=format,
+        inputs=[dict(file=os.path.basename(file_name), sha256=cache.content_hash(file_name))
+                for file_name in input_files],
+        criteria=criteria if isinstance(criteria, str) else list(criteria),
+        sheets=list(sheets),
+        template=cache.content_hash(template_path(template)),
+        options={key: value for key, value in options.items()
+                 if key not in runtime_options and value is not None},
+    )
+    # Same form as read back from the file
+    return json.loads(json.dumps(manifest, sort_keys=True, default=str))
+
+
+def read_manifest(file_name_docx: str):
+    try:
+        with open(manifest_file_name(file_name_docx), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def output_signature(file_name_docx: str) -> dict:
+    return dict(size=os.path.getsize(file_name_docx),
+                sha256=cache.content_hash(file_name_docx))
+
+
+def write_manifest(file_name_docx: str, manifest: dict, requirements: int):
+    """ write manifest beside output, output itself is identified by size and hash """
+    with open(manifest_file_name(file_name_docx), 'w', encoding='utf-8') as f:
+        json.dump(dict(conversion=manifest, requirements=requirements,
+                       output=output_signature(file_name_docx)), f,
+                  ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def up_to_date(file_name_docx: str, manifest: dict) -> bool:
+    """ return True if output exists, was made from the same inputs and
+        options and was not changed since
+    """
+    if not os.path.isfile(file_name_docx):
+        return False
+    stored = read_manifest(file_name_docx)
+    if stored is None or stored.get('conversion') != manifest:
+        return False
+    output = stored.get('output') or dict()
+    # Size is compared first to avoid hashing output that differs anyway
+    return output.get('size') == os.path.getsize(file_name_docx) \
+        and output == output_signature(file_name_docx)
+
+
 class ExcelToWord(object):
 
+    required_styles = ('Body Text',)
+    # Rendered sheets are cached as fragments of document body
+    cache_fragments = True
+    # Attributes that grow while sheet is rendered, kept in fragments as deltas
+    fragment_totals = ('count_requirements',)
+    # Fewer rows to render are not worth starting worker processes
+    parallel_min_rows = 2000
+
     def __init__(self,
                  input_files: list,
                  file_name_docx: str,
                  criteria: list=list(),
-                 sheets: list=list()):
+                 sheets: list=list(),
+                 stream: bool=False,
+                 template: str=None,
+                 only: list=None,
+                 use_cache: bool=True,
+                 build_date: date=None,
+                 jobs: int=None,
+                 books: list=None,
+                 lazy: bool=False,
+                 memory_budget: int=None):
         self.input_files = input_files
         self.file_name_docx = file_name_docx
         #self.wb = xlrd.open_workbook(file_name_xls, formatting_info=True)
-        self.wb = [xlrd.open_workbook(file_name_xls, formatting_info=True)
-                   for file_name_xls in input_files]
-        self.style = None
-
+        # books are compiled input_files when they are parsed already
+        # lazy keeps one sheet in memory at a time, see LazyWorkbook,
+        # memory_budget spills sheets to disk beyond it, see RowStore
+        if books is None:
+            books = load_workbooks(input_files, use_cache, jobs, lazy, memory_budget)
+        self.books = books
+        self.row_store = next((book.store for book in books
+                               if isinstance(book, StoredWorkbook)), None)
+        self.use_cache = use_cache
+        self.jobs = jobs
+        self.lazy = lazy
+
+        # List of criteria names any of which selects row or expression
         self.criteria = criteria
+        self.selection = selection.parse(criteria)
         self.sheets = sheets
+        self.template = template
+        # Options that change output, recorded in conversion manifest
+        self.options = dict(only=only, build_date=build_date)
+        self.manifest = None
+        # (input file, sheet name) pairs to process, used for volumes
+        self.only = None if only is None else set(only)
         # Hint for pyinstaller to include default.docx into package
         # './venv/lib/python3.7/site-packages/docx/templates/default.docx'
-        self.doc = Document(default_template())
+        self.doc = load_template(template)
+        self.styles = StyleTable(self.doc)
+        self.styles.require(self.required_styles)
+        # Fixed build date makes output reproducible: it is used for date
+        # marker, core properties and zip entry timestamps
+        self.build_date = build_date
+        if build_date is not None:
+            self.set_core_dates()
+        self.stream = DocxStream(self.doc, file_name_docx, self.zip_date_time()) \
+            if stream else None
         self.count_requirements = 0
-
-    def criteria_dict(self, sheet):
-        result = dict()
-        for n in range(2, sheet.ncols):
-            cell = sheet.cell(0, n)
-            value = cell.value.strip()
-            if value == '':
-                break
-            if value in result:
-                raise RuntimeError('Criteria names should be unique')
-            result[value] = n
-        return result
+        self.template_key = cache.content_hash(template_path(template)) \
+            if self.cache_fragments else None
+        self.recording = None
+        # Fragments rendered by worker processes and fragments rendered in one
+        self.prerendered = dict()
+        self.rendered = None
+        self.fragment_hits = 0
+        self.fragment_misses = 0
 
     """
     def list_packages(self):
@@ -276,20 +1025,17 @@ class ExcelToWord(object):
         return result
     """
     def list_packages(self):
-        result = []
-        for w in self.wb:
-            for sheet in w.sheets()[1:]:
-                for key in self.criteria_dict(sheet).keys():
-                    if key in result:
-                        continue
-                    result.append(key)
-            #result.append(book_result)
-        return result
+        # dict keeps first appearance order and finds duplicates at once
+        result = dict()
+        for book in self.books:
+            for sheet in book.sheets:
+                result.update(dict.fromkeys(sheet.criteria))
+        return list(result)
 
     def list_sheets(self):
         result = []
-        for w in self.wb:
-            for sheet in w.sheets()[1:]:
+        for book in self.books:
+            for sheet in book.sheets:
                 result.append(sheet.name)
             #result.append(book_result)
         return result
@@ -331,95 +1077,300 @@ class ExcelToWord(object):
 
     def count_scope_lines(self):
         result = 0
-        for w in self.wb:
-            for sheet in w.sheets()[1:]:
-                result += (sheet.nrows-1)
+        for book in self.books:
+            for sheet in book.sheets:
+                result += sheet.nrows
         return result
 
     def run(self):
-        self.prefix()
+        self.start()
         yield from self.process()
         self.footer()
 
-    def checked(self, value):
-        if isinstance(value, str):
-            return value.strip() != ''
-        elif isinstance(value, int):
-            return value != 0
-        elif isinstance(value, float):
-            return value != 0.0
-        else:
-            raise RuntimeError('{!r}: Wrond option cell type'.format(value))
+    def start(self, prerender: bool=True):
+        """ prerender is off when rows are fed by FanOut walk """
+        self.manifest = conversion_manifest(self.name, self.input_files, self.criteria,
+                                            self.sheets, self.template, **self.options)
+        if self.stream is not None:
+            self.stream.open()
+        self.prefix()
+        if prerender:
+            self.prerender()
 
-    def should_skip(self, row, criteria_heading):
-#        print('should_skip({}, {})'.format('|'.join([str(r.value) for r in row]), criteria_heading))
-        if not self.criteria:
-#            print('Skip')
+    def includes(self, book: CompiledWorkbook, sheet: CompiledSheet, verbose: bool=True) -> bool:
+        if self.sheets and sheet.name not in self.sheets:
+            if verbose:
+                print('{} not in {}'.format(sheet.name, self.sheets))
             return False
-        # criteria = set(SPE, TMDS-AM, DDAN)
-        # criteria_heading = {SPE: 3, SPC: 4, ESEL: 5}
-        for crit in self.criteria:
-#            print('check crit = |{}|'.format(crit))
-            if crit not in criteria_heading:
-#                print('not in criteria_heading')
-                continue
-            col = criteria_heading[crit]
-#            print('col = {}'.format(col))
-            if self.checked(row[col].value):
-#                print('is checked')
-                return False
-        return True
+        return self.only is None or (book.file_name, sheet.name) in self.only
+
+    def iter_sheets(self, verbose: bool=True):
+        """ yield (book, sheet) for every sheet to convert """
+        for book in self.books:
+            for sheet in book.sheets:
+                if self.includes(book, sheet, verbose):
+                    yield book, sheet
+
+    def selected_lines(self, sheet: CompiledSheet) -> list:
+        return sheet.lines(self.selection)
 
     def process(self):
         count = 0
-        for w, file_name in zip(self.wb, self.input_files):
-            self.style = CellStyle(w)
-            for n, sheet in enumerate(w.sheets()[1:]):
-                if self.sheets and sheet.name not in self.sheets:
-                    print('{} not in {}'.format(sheet.name, self.sheets))
-                    continue
-                criteria_heading = self.criteria_dict(sheet)
-    #            print('%s: ' % sheet.name, end='')
-                #from random import randint
-    #            with spinner(n) as spin:
-                for line in range(1, sheet.nrows):
-                    #spin()
-                    if self.should_skip(sheet.row(line), criteria_heading):
-#                        print('Skip!')
-                        continue
-                    count += 1
-                    yield os.path.basename(file_name), sheet.name, count
-#                    print('Do not skip')
-                    cell = sheet.cell(line, 1)
-                    if cell.value is None:
-                        break
-                    try:
-                        text = cell.value.strip()
-                    except AttributeError:
-                        raise RuntimeError(f'Error on line {line+1} on sheet "{sheet.name}"')
-                    if text == '':
-                        continue
-                    heading = map_style_to_heading_size(self.style(cell))
-                    if heading is None:
-                        self.count_requirements += 1
-                        text, depth = item_depth(text)
-                        self.item(text, depth)
-                    else:
-                        self.heading(text, level=heading)
-    #            print('done')
+        for book, sheet in self.iter_sheets():
+            lines = self.selected_lines(sheet)
+            spliced = self.begin_sheet(book, sheet, lines)
+            for line in lines:
+                count += 1
+                yield book.base_name, sheet.name, count
+                if not spliced:
+                    self.render_line(sheet, line)
+            if not spliced:
+                self.stop_recording()
+
+    def begin_sheet(self, book: CompiledWorkbook, sheet: CompiledSheet, lines: list) -> bool:
+        """ start sheet of selected lines, return True if it is taken from fragment """
+        self.start_sheet(book.file_name, sheet.name)
+        key = self.fragment_key(sheet, lines)
+        fragment = self.find_fragment(key)
+        if fragment is not None:
+            self.splice(fragment)
+            return True
+        self.start_recording(key if self.use_cache or self.rendered is not None else None)
+        return False
+
+    def render_line(self, sheet: CompiledSheet, line: int):
+        kind = sheet.kinds[line]
+        if kind == KIND_EMPTY:
+            return
+        if kind == KIND_ERROR:
+            raise RuntimeError(sheet.texts[line])
+        if kind == KIND_ITEM:
+            self.count_requirements += 1
+            self.item(sheet.texts[line], sheet.levels[line])
+        else:
+            self.heading(sheet.texts[line], level=sheet.levels[line])
+        self.flush()
+
+    def start_sheet(self, file_name: str, sheet_name: str):
+        pass
+
+    def fragment_state(self) -> dict:
+        """ return converter state that rendering of next sheet depends on """
+        return dict()
+
+    def restore_fragment_state(self, state: dict):
+        pass
+
+    def fragment_key(self, sheet: CompiledSheet, lines: list):
+        """ return cache key of sheet rendered from selected lines or None
+
+            Key covers everything the rendered XML depends on: selected
+            rows, format, template and converter state at sheet start
+        """
+        if self.template_key is None:
+            return None
+        kinds = sheet.kinds
+        if any(kinds[line] == KIND_ERROR for line in lines):
+            return None
+        digest = hashlib.sha256(repr((
+            FRAGMENT_VERSION, self.name, self.template_key,
+            sorted(self.fragment_state().items()),
+        )).encode())
+        texts, levels = sheet.texts, sheet.levels
+        for line in lines:
+            if kinds[line] != KIND_EMPTY:
+                digest.update(b'%d %d ' % (kinds[line], levels[line]))
+                digest.update(texts[line].encode())
+                digest.update(b'\0')
+        return digest.hexdigest()
+
+    def find_fragment(self, key):
+        if key is None:
+            return None
+        fragment = self.prerendered.pop(key, None)
+        if fragment is None and self.use_cache:
+            fragment = fragment_cache.get(key)
+            if fragment is not None:
+                self.fragment_hits += 1
+        if fragment is not None and self.rendered is not None:
+            self.rendered[key] = fragment
+        return fragment
+
+    def parallel(self) -> bool:
+        """ return True if sheets can be rendered by worker processes """
+        # Prerendering needs all sheets at once, bounded memory modes avoid that
+        return self.template_key is not None and not self.lazy and self.row_store is None \
+            and (self.jobs or os.cpu_count() or 1) > 1
+
+    def prerender(self):
+        """ render sheets missing in cache concurrently into fragments
+
+            Converter state at the start of every sheet is found by a scan,
+            so every sheet is rendered independently. Fragments are
+            spliced by process() in order; a sheet whose state differs from
+            the scan (which should not happen) is rendered as usual.
+        """
+        if not self.parallel():
+            return
+        scanned = SheetScan(self.input_files, None, criteria=self.criteria,
+                            only=[(book.file_name, sheet.name)
+                                  for book, sheet in self.iter_sheets(verbose=False)],
+                            numbering=self.options.get('numbering'),
+                            books=self.books).scan()
+        sheets = {(book.file_name, sheet.name): (book, sheet)
+                  for book, sheet in self.iter_sheets(verbose=False)}
+        initial = self.fragment_state()
+        tasks = []
+        rows = 0
+        for entry in scanned:
+            book, sheet = sheets[(entry['file_name'], entry['sheet_name'])]
+            self.restore_fragment_state(dict(initial, numbering=entry['numbering']))
+            key = self.fragment_key(sheet, self.selected_lines(sheet))
+            if key is None or self.use_cache and key in fragment_cache:
+                continue
+            tasks.append((self.name, CompiledWorkbook(book.file_name, [sheet]),
+                          self.fragment_state(), self.worker_options()))
+            rows += entry['rows']
+        self.restore_fragment_state(initial)
+        if len(tasks) < 2 or rows < self.parallel_min_rows:
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            for fragments in executor.map(render_sheet, *zip(*tasks)):
+                self.prerendered.update(fragments)
+                self.fragment_misses += len(fragments)
+
+    def worker_options(self) -> dict:
+        """ return keyword arguments for converter rendering sheets in worker process """
+        return dict(criteria=self.criteria, template=self.template,
+                    use_cache=self.use_cache, jobs=1)
+
+    def fragment_container(self):
+        """ return element that rendered rows are appended to """
+        return self.doc.element.body
+
+    def fragment_elements(self, container) -> list:
+        return [child for child in container if child.tag != qn('w:sectPr')]
+
+    def start_recording(self, key):
+        if key is None:
+            self.recording = None
+            return
+        container = self.fragment_container()
+        self.recording = dict(
+            key=key, container=container,
+            mark=len(self.fragment_elements(container)), elements=[],
+            totals={name: getattr(self, name) for name in self.fragment_totals},
+        )
+
+    def record(self):
+        """ serialize elements rendered since last call into recording """
+        recording = self.recording
+        if recording is None:
+            return
+        container = self.fragment_container()
+        if container is not recording['container']:
+            # Sheet went on to another table, it is not a single fragment
+            self.recording = None
+            return
+        elements = self.fragment_elements(container)
+        recording['elements'].extend(serialize(e) for e in elements[recording['mark']:])
+        recording['mark'] = len(elements)
+
+    def stop_recording(self):
+        self.record()
+        recording, self.recording = self.recording, None
+        if recording is None:
+            return
+        fragment = dict(
+            elements=recording['elements'],
+            totals={name: getattr(self, name) - value
+                    for name, value in recording['totals'].items()},
+            state=self.fragment_state(),
+        )
+        self.fragment_misses += 1
+        if self.rendered is not None:
+            self.rendered[recording['key']] = fragment
+        if self.use_cache:
+            fragment_cache.put(recording['key'], fragment)
+
+    def splice(self, fragment: dict):
+        """ add cached fragment to the document as if its sheet was rendered """
+        container = self.fragment_container()
+        sectPr = container.find(qn('w:sectPr'))
+        for xml in fragment['elements']:
+            element = parse_xml(xml)
+            if sectPr is None:
+                container.append(element)
+            else:
+                sectPr.addprevious(element)
+        for name, delta in fragment['totals'].items():
+            setattr(self, name, getattr(self, name) + delta)
+        self.restore_fragment_state(fragment['state'])
+        self.flush()
+
+    def set_core_dates(self):
+        props = self.doc.core_properties
+        props.created = props.modified = datetime.combine(self.build_date, datetime.min.time())
+        props.revision = 1
+
+    def zip_date_time(self):
+        if self.build_date is None:
+            return None
+        return self.build_date.timetuple()[:6]
 
     def footer(self):
-        today = strftime('%d%m%Y')
+        today = (self.build_date or date.today()).strftime('%d%m%Y')
         date_marker = 'GD{}DG'.format(today)
-        p = self.doc.add_paragraph(date_marker)
-        p.style = self.doc.styles['Body Text']
+        p = self.add_paragraph(date_marker, 'Body Text')
         p.style.font.size = Pt(2)
         p.style.font.color.rgb = RGBColor(0xFF, 0xFF, 0xFF)
-        self.doc.save(self.file_name_docx)
+        self.save()
+
+    def report(self):
+        """ return list of lines to print after conversion """
+        result = []
+        if self.fragment_hits or self.fragment_misses:
+            result.append('Sheet fragments: {} taken from cache, {} rendered'.format(
+                self.fragment_hits, self.fragment_misses))
+        if self.row_store is not None:
+            result.append(self.row_store.report())
+        peak = peak_memory()
+        if peak is not None:
+            result.append('Peak memory: {:.1f} MB'.format(peak / (1024 * 1024)))
+        return result
+
+    def add_paragraph(self, text: str, style: str):
+        p = self.doc.add_paragraph(text)
+        p._p.style = self.styles[style]
+        return p
+
+    def flush(self):
+        """ hand completed body elements over to streaming output """
+        if self.stream is not None:
+            self.record()
+            self.stream.flush()
+            self.mark_flushed()
+
+    def mark_flushed(self):
+        if self.recording is not None:
+            self.recording['mark'] = len(self.fragment_elements(self.fragment_container()))
+
+    def save(self):
+        if self.stream is None and self.build_date is not None:
+            save_reproducible(self.doc, self.file_name_docx, self.zip_date_time())
+        elif self.stream is None:
+            self.doc.save(self.file_name_docx)
+        else:
+            self.stream.close()
+        if self.manifest is not None:
+            write_manifest(self.file_name_docx, self.manifest, self.count_requirements)
 
 
 class Counter(ExcelToWord):
     name = 'counter'
+    required_styles = ()
+    cache_fragments = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -437,13 +1388,17 @@ class Counter(ExcelToWord):
 class ExcelToWordList(ExcelToWord):
 
     name = 'list'
+    required_styles = ExcelToWord.required_styles + (
+        'Title', 'Heading 1', 'Heading 2', 'Heading 3',
+        'List Number', 'List Bullet 2', 'List Bullet 3')
 
     def heading(self, text: str, level: int):
-        self.doc.add_heading(text, level=level)
+        # Same styles as doc.add_heading(text, level=level)
+        self.add_paragraph(text, 'Heading %d' % level if level else 'Title')
 
     def item(self, text: str, depth: int):
         style = ['List Number', 'List Bullet 2', 'List Bullet 3']
-        self.doc.add_paragraph(text, style=style[depth])
+        self.add_paragraph(text, style[depth])
 
 
 MAX_DEPTH = 6
@@ -452,20 +1407,63 @@ MAX_DEPTH = 6
 class ExcelToWordTable(ExcelToWord):
 
     name = 'fancy'
+    required_styles = ExcelToWord.required_styles + (
+        'Heading 1', 'Heading 2', 'Heading 3', 'Heading 4',
+        'List Bullet', 'List Bullet 2')
 
     widths = (Mm(16), Mm(120), Mm(12))
 
-    def __init__(self, *args, **kwargs):
+    fragment_totals = ExcelToWord.fragment_totals + ('saved_bytes', 'table_rows')
+
+    # Compact variant takes borders and widths from table style and grid
+    compact = False
+    compact_style = 'ExToWord Fancy'
+    compact_look = ('firstRow', 'lastColumn')
+
+    def __init__(self, *args, chunk_level: int=None, chunk_rows: int=None,
+                 numbering: tuple=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.table = None
         self.counters = [0]*MAX_DEPTH
         self.last_heading_depth = 1
+        if numbering is not None:
+            self.restore_numbering(numbering)
+        self.prototypes = dict()
+        self.savings = dict()
+        self.saved_bytes = 0
+        # Start new table at every heading of chunk_level (1 - Heading 1)
+        # or higher and after every chunk_rows rows
+        self.chunk_level = chunk_level
+        self.chunk_rows = chunk_rows
+        self.table_rows = 0
+        self.options.update(chunk_level=chunk_level, chunk_rows=chunk_rows,
+                            numbering=numbering)
 
     def setup_widths(self, row):
         for cell, width in zip(row.cells, self.widths):
             cell.width = width
 
     def prefix(self):
+        self.new_table()
+
+    def new_table(self):
+        if self.compact:
+            self.add_compact_table()
+        else:
+            self.add_table()
+        if not self.prototypes:
+            self.build_prototypes()
+        self.table_rows = 0
+
+    def next_table(self):
+        """ continue with new table that has the same header row """
+        if self.table_rows == 0:
+            return
+        # Word joins adjacent tables, so keep paragraph between them
+        self.doc.add_paragraph()
+        self.new_table()
+
+    def add_table(self):
         #self.table = self.doc.add_table(rows=1, cols=3, style='Medium Grid 1 Accent 3')
         self.table = self.doc.add_table(rows=1, cols=3)
 #        self.table.autofit = True
@@ -478,6 +1476,161 @@ class ExcelToWordTable(ExcelToWord):
         for c in row.cells:
             single_border(c)
 
+    def add_compact_table(self):
+        self.table = self.doc.add_table(rows=1, cols=3)
+        self.table.autofit = False
+        tbl = self.table._tbl
+        tbl.tblStyle_val = self.compact_style_id()
+        tblW = tbl.tblPr.find(qn('w:tblW'))
+        tblW.set(qn('w:type'), 'dxa')
+        tblW.set(qn('w:w'), str(sum(width.twips for width in self.widths)))
+        tblLook = tbl.tblPr.find(qn('w:tblLook'))
+        val = 0
+        for key, mask in table_look_flags.items():
+            flag = key in self.compact_look
+            tblLook.set(qn('w:{}'.format(key)), str(int(flag)))
+            val |= mask if flag else 0
+        for key in ('noHBand', 'noVBand'):
+            tblLook.set(qn('w:{}'.format(key)), '1')
+        tblLook.set(qn('w:val'), '{:04X}'.format(val | 0x0600))
+        for gridCol, width in zip(tbl.tblGrid.gridCol_lst, self.widths):
+            gridCol.w = width
+        row = self.table.rows[0]
+        set_repeat_table_header(row)
+        for cell, text in zip(row.cells, ('№ пп', 'Требование', 'Да/Нет')):
+            cell._tc._remove_tcPr()
+            cell.text = text
+
+    def compact_style_id(self):
+        """ return styleId of compact table style, adding it to document if needed """
+        try:
+            return self.styles[self.compact_style]
+        except KeyError:
+            pass
+        style = self.compact_table_style()
+        self.doc.styles.element.append(style)
+        self.styles.ids[self.compact_style] = style.styleId
+        return style.styleId
+
+    def compact_table_style(self):
+        default = self.doc.styles.element.default_for(WD_STYLE_TYPE.TABLE)
+        return table_style(
+            self.compact_style,
+            based_on=None if default is None else default.styleId,
+            firstRow=dict(
+                top={"sz": 4, "val": "single"},
+                bottom={"sz": 4, "val": "single"},
+                start={"sz": 4, "val": "single"},
+                end={"sz": 4, "val": "single"},
+            ),
+            lastCol=dict(
+                top={"sz": 4, "val": "single"},
+                bottom={"sz": 4, "val": "single"},
+                start={"sz": 4, "val": "single"},
+                end={"sz": 4, "val": "single"},
+            ),
+        )
+
+    def build_prototypes(self):
+        """ Pre-build w:tr elements for every kind of row
+
+            Rows are added to the table as copies of these prototypes, so
+            python-docx never has to walk the whole table grid
+            (which _Row.cells does) for each new requirement.
+        """
+        for kind, builder in (('heading', self.heading_prototype),
+                              ('item', self.item_prototype)):
+            self.prototypes[kind] = builder(self.compact)
+            if self.compact:
+                self.savings[kind] = len(serialize(builder(False))) - \
+                                     len(serialize(self.prototypes[kind]))
+
+    def flush(self):
+        if self.stream is not None:
+            self.record()
+            self.stream.flush(self.table._tbl)
+            self.mark_flushed()
+
+    def fragment_container(self):
+        return self.table._tbl
+
+    def fragment_elements(self, container) -> list:
+        return container.tr_lst
+
+    def fragment_state(self) -> dict:
+        # Chunking depends on rows already in the table
+        if self.chunk_rows:
+            table_rows = self.table_rows
+        elif self.chunk_level is not None:
+            table_rows = self.table_rows == 0
+        else:
+            table_rows = None
+        return dict(
+            numbering=self.numbering_state(),
+            chunk_level=self.chunk_level,
+            chunk_rows=self.chunk_rows,
+            table_rows=table_rows,
+        )
+
+    def restore_fragment_state(self, state: dict):
+        self.restore_numbering(state['numbering'])
+
+    def parallel(self) -> bool:
+        # Chunked sheets may span several tables, they are not fragments
+        return self.chunk_level is None and self.chunk_rows is None and super().parallel()
+
+    def grid_widths(self):
+        return [gridCol.w for gridCol in self.table._tbl.tblGrid.gridCol_lst]
+
+    def new_tr(self, widths):
+        """ return w:tr with a cell for every width, None width is taken from grid """
+        tr = OxmlElement('w:tr')
+        for width in widths:
+            tc = tr.add_tc()
+            if width is not None:
+                tc.width = width
+        return tr
+
+    def heading_prototype(self, compact: bool):
+        # Same XML as add_row() followed by merge() of all cells
+        widths = self.grid_widths()
+        if compact:
+            tr = self.new_tr([None])
+            cell = _Cell(tr.tc_lst[0], self.table)
+            # Spans last column, so keep it off lastCol borders of the style
+            set_cell_border(cell, top={"val": "nil"}, bottom={"val": "nil"},
+                            start={"val": "nil"}, end={"val": "nil"})
+        else:
+            tr = self.new_tr(widths[:1])
+            tr.tc_lst[0].width = sum(widths)
+        tr.tc_lst[0].grid_span = len(widths)
+        return tr
+
+    def item_prototype(self, compact: bool):
+        tr = self.new_tr([None] * len(self.widths) if compact else self.widths)
+        cell = _Cell(tr.tc_lst[2], self.table)
+        if not compact:
+            single_border(cell)
+        cell.text = ' '
+        return tr
+
+    def add_tr(self, kind):
+        """ append copy of prototype row to the table, return its cells """
+        if self.chunk_rows and self.table_rows >= self.chunk_rows:
+            self.next_table()
+        tr = deepcopy(self.prototypes[kind])
+        self.table._tbl.append(tr)
+        self.table_rows += 1
+        self.saved_bytes += self.savings.get(kind, 0)
+        return [_Cell(tc, self.table) for tc in tr.tc_lst]
+
+    def numbering_state(self) -> tuple:
+        return tuple(self.counters), self.last_heading_depth
+
+    def restore_numbering(self, state: tuple):
+        counters, self.last_heading_depth = state
+        self.counters = list(counters)
+
     def index(self, level: int) -> str:
         """ return str index '1.3.2' """
         if level == 0:
@@ -488,40 +1641,51 @@ class ExcelToWordTable(ExcelToWord):
             self.counters[i] = 0
         return '.'.join([str(c) for c in self.counters[0:level+1]])
 
+    def chunk(self, level: int):
+        if self.chunk_level is not None and level < self.chunk_level:
+            self.next_table()
+
     def heading(self, text: str, level: int):
         self.last_heading_depth = level+1
-        row_cells = self.table.add_row().cells
-        row_cells[0].merge(row_cells[2])
+        self.chunk(level)
+        row_cells = self.add_tr('heading')
         p = row_cells[0].paragraphs[0]
-        p.style = 'Heading %s' % (level + 1)
+        p._p.style = self.styles['Heading %s' % (level + 1)]
         p.text = '{}  {}'.format(self.index(level), text)
 
     def item(self, text: str, depth: int):
-        row = self.table.add_row()
-        self.setup_widths(row)
-        row.cells[0].text = self.index(self.last_heading_depth + depth)
+        row_cells = self.add_tr('item')
+        row_cells[0].text = self.index(self.last_heading_depth + depth)
         style = [None, 'List Bullet', 'List Bullet 2']
         #style = [None, 'List Bullet 2', 'List Bullet 3']
-        p = row.cells[1].paragraphs[0]
-        p.style = style[depth]
+        p = row_cells[1].paragraphs[0]
+        p._p.style = self.styles[style[depth]]
         p.text = text
-        single_border(row.cells[2])
-        row.cells[2].text = ' '
+
+    def report(self):
+        result = super().report()
+        if self.compact:
+            with zipfile.ZipFile(self.file_name_docx) as z:
+                size = z.getinfo('word/document.xml').file_size
+            full_size = size + self.saved_bytes
+            result.append('Compact table: document.xml is {} bytes, {} bytes ({:.0%}) '
+                          'less than with per-cell formatting'.format(
+                              size, self.saved_bytes, self.saved_bytes / full_size))
+        return result
 
 
 class ExcelToWordPlainTable(ExcelToWordTable):
 
     name = 'table'
+    required_styles = ExcelToWord.required_styles + (
+        'Table Grid', 'List Bullet', 'List Bullet 2')
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.table = None
-        self.counters = [0]*MAX_DEPTH
-        self.last_heading_depth = 1
+    compact_style = 'ExToWord Table'
+    compact_look = ('firstRow',)
 
-    def prefix(self):
-        self.table = self.doc.add_table(rows=1, cols=3,
-                                        style='Table Grid')
+    def add_table(self):
+        self.table = self.doc.add_table(rows=1, cols=3)
+        self.table._tbl.tblStyle_val = self.styles['Table Grid']
 
         self.setup_widths(self.table.rows[0])
         set_repeat_table_header(self.table.rows[0])
@@ -532,14 +1696,278 @@ class ExcelToWordPlainTable(ExcelToWordTable):
         for cell in hdr_cells:
             head_cell_border(cell)
 
+    def compact_table_style(self):
+        return table_style(
+            self.compact_style,
+            based_on=self.styles['Table Grid'],
+            firstRow=dict(bottom={"sz": 8, "val": "double"}),
+        )
+
+    def heading_prototype(self, compact: bool):
+        tr = self.new_tr([None] * len(self.widths) if compact else self.widths)
+        _Cell(tr.tc_lst[2], self.table).text = ''
+        return tr
+
     def heading(self, text: str, level: int):
         self.last_heading_depth = level+1
-        row = self.table.add_row()
-        self.setup_widths(row)
-        row_cells = row.cells
+        self.chunk(level)
+        row_cells = self.add_tr('heading')
         row_cells[0].add_paragraph(self.index(level))
         row_cells[1].add_paragraph(text)
-        row_cells[2].text = ''
+
+
+class ExcelToWordCompactTable(ExcelToWordTable):
+
+    name = 'fancy-compact'
+    compact = True
+
+
+class ExcelToWordCompactPlainTable(ExcelToWordPlainTable):
+
+    name = 'table-compact'
+    compact = True
+
+
+class SheetScan(ExcelToWordTable):
+    """ Walk rows without rendering them
+
+        Collects number of rows, approximate size and numbering state
+        at the start of every sheet.
+    """
+
+    name = 'scan'
+    required_styles = ()
+    cache_fragments = False
+
+    # Approximate XML size of a row beside its text
+    row_overhead = 600
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scanned = list()
+
+    def prefix(self):
+        pass
+
+    def start_sheet(self, file_name: str, sheet_name: str):
+        self.scanned.append(dict(file_name=file_name,
+                                 sheet_name=sheet_name,
+                                 numbering=self.numbering_state(),
+                                 rows=0,
+                                 size=0))
+
+    def add_row(self, text: str):
+        self.scanned[-1]['rows'] += 1
+        self.scanned[-1]['size'] += len(text.encode('utf-8')) + self.row_overhead
+
+    def heading(self, text: str, level: int):
+        self.last_heading_depth = level+1
+        self.index(level)
+        self.add_row(text)
+
+    def item(self, text: str, depth: int):
+        self.index(self.last_heading_depth + depth)
+        self.add_row(text)
+
+    def scan(self):
+        for _ in self.process():
+            pass
+        return self.scanned
+
+
+volume_modes = ('workbook', 'sheet', 'rows', 'size')
+
+
+def plan_volumes(scanned: list, mode: str, budget: int=None) -> list:
+    """ group scanned sheets into volumes
+
+        mode is one of volume_modes, budget is number of rows for 'rows'
+        and approximate bytes of document.xml for 'size'
+    """
+    if mode not in volume_modes:
+        raise RuntimeError('{}: unknown volume mode'.format(mode))
+    if mode in ('rows', 'size') and not budget:
+        raise RuntimeError('Volume budget is required for {} mode'.format(mode))
+    volumes = []
+    total = 0
+    for sheet in scanned:
+        if not volumes:
+            new_volume = True
+        elif mode == 'workbook':
+            new_volume = sheet['file_name'] != volumes[-1][-1]['file_name']
+        elif mode == 'sheet':
+            new_volume = True
+        else:
+            new_volume = total + sheet[mode] > budget
+        if new_volume:
+            volumes.append([])
+            total = 0
+        volumes[-1].append(sheet)
+        if mode in ('rows', 'size'):
+            total += sheet[mode]
+    return volumes
+
+
+def volume_file_name(file_name_docx: str, number: int) -> str:
+    name, ext = os.path.splitext(file_name_docx)
+    return '{}_vol{:02d}{}'.format(name, number, ext)
+
+
+def index_file_name(file_name_docx: str) -> str:
+    name, ext = os.path.splitext(file_name_docx)
+    return '{}_index.txt'.format(name)
+
+
+def render_sheet(format: str, book: CompiledWorkbook, state: dict, options: dict) -> dict:
+    """ render the only sheet of book from converter state, return {key: fragment} """
+    converter = available_converters[format]([book.file_name], None, books=[book], **options)
+    converter.rendered = dict()
+    converter.prefix()
+    converter.restore_fragment_state(state)
+    for _ in converter.process():
+        pass
+    return converter.rendered
+
+
+def render_volume(format: str, input_files: list, file_name_docx: str,
+                  only: list, options: dict) -> int:
+    """ render one volume, return number of requirements in it """
+    converter = available_converters[format](input_files, file_name_docx,
+                                             only=only, **options)
+    for _ in converter.run():
+        pass
+    return converter.count_requirements
+
+
+def convert_volumes(converter_class,
+                    input_files: list,
+                    file_name_docx: str,
+                    mode: str,
+                    budget: int=None,
+                    jobs: int=None,
+                    force: bool=False,
+                    **options) -> list:
+    """ split output into volume documents
+
+        Sheets are kept whole. Volumes are rendered concurrently by up to
+        jobs worker processes (jobs=1 renders them one by one), heading
+        numbering of table formats continues from volume to volume.
+        Volumes that are up to date with their manifest are skipped
+        unless force is set.
+        Index file listing sheets of every volume is written beside them.
+        Return list of (volume file name, sheets, number of requirements,
+        True if volume was rebuilt)
+    """
+    scan_options = {key: options[key]
+                    for key in ('criteria', 'sheets', 'use_cache', 'lazy', 'memory_budget')
+                    if key in options}
+    scanned = SheetScan(input_files, file_name_docx, jobs=jobs, **scan_options).scan()
+    volumes = plan_volumes(scanned, mode, budget)
+
+    tasks = []
+    counts = dict()
+    for number, volume in enumerate(volumes, 1):
+        files = [f for f in input_files if f in {s['file_name'] for s in volume}]
+        only = [(s['file_name'], s['sheet_name']) for s in volume]
+        # Volumes themselves are rendered by worker processes
+        volume_options = dict(options, jobs=1)
+        if issubclass(converter_class, ExcelToWordTable):
+            volume_options['numbering'] = volume[0]['numbering']
+        volume_name = volume_file_name(file_name_docx, number)
+        if not force and up_to_date(volume_name, conversion_manifest(
+                converter_class.name, files, only=only, **volume_options)):
+            counts[volume_name] = read_manifest(volume_name)['requirements']
+            continue
+        tasks.append((converter_class.name, files, volume_name, only, volume_options))
+
+    if jobs == 1 or len(tasks) < 2:
+        rendered = [render_volume(*task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            rendered = list(executor.map(render_volume, *zip(*tasks)))
+    counts.update((task[2], count) for task, count in zip(tasks, rendered))
+    rebuilt = {task[2] for task in tasks}
+
+    result = [(volume_file_name(file_name_docx, number), volume)
+              for number, volume in enumerate(volumes, 1)]
+    result = [(file_name, volume, counts[file_name], file_name in rebuilt)
+              for file_name, volume in result]
+    with open(index_file_name(file_name_docx), 'w', encoding='utf-8') as f:
+        for file_name, volume, count, _ in result:
+            f.write('{} ({} requirements)\n'.format(os.path.basename(file_name), count))
+            for sheet in volume:
+                f.write('    {}: {} ({} rows)\n'.format(
+                    os.path.basename(sheet['file_name']), sheet['sheet_name'], sheet['rows']))
+    return result
+
+
+def target_file_name(file_name_docx: str, format: str, criteria, sheets: list) -> str:
+    """ return output name for fan-out target, e.g. 'a_01012020_fancy_SPE+DDAN.docx' """
+    name, ext = os.path.splitext(file_name_docx)
+    parts = [format] + [names if isinstance(names, str) else '+'.join(names)
+                        for names in (criteria, sheets) if names]
+    return '{}_{}{}'.format(name, re.sub(r'[^\w.+-]+', '-', '_'.join(parts)), ext)
+
+
+class FanOut(object):
+    """ Convert inputs into several outputs at once
+
+        targets is a list of (criteria, sheets, format, output file name).
+        Workbooks are parsed once and rows are walked once: every row is
+        rendered by all targets that select it. options are passed to
+        every converter, chunk_level and chunk_rows to table formats only.
+    """
+
+    chunk_options = ('chunk_level', 'chunk_rows')
+
+    def __init__(self, input_files: list, targets: list,
+                 use_cache: bool=True, jobs: int=None, **options):
+        self.input_files = input_files
+        self.books = load_workbooks(input_files, use_cache, jobs, options.get('lazy', False),
+                                    options.get('memory_budget'))
+        self.converters = []
+        for criteria, sheets, format, file_name_docx in targets:
+            converter_class = available_converters[format]
+            self.converters.append(converter_class(
+                input_files, file_name_docx, criteria=criteria, sheets=sheets,
+                use_cache=use_cache, jobs=jobs, books=self.books,
+                **self.converter_options(converter_class, options)))
+
+    @classmethod
+    def converter_options(cls, converter_class, options: dict) -> dict:
+        return {key: value for key, value in options.items()
+                if key not in cls.chunk_options
+                or issubclass(converter_class, ExcelToWordTable)}
+
+    def run(self):
+        # Prerendering would scan and render all rows once per target,
+        # sheets are rendered by this single walk instead
+        for converter in self.converters:
+            converter.start(prerender=False)
+        count = 0
+        for book in self.books:
+            for sheet in book.sheets:
+                active = []
+                routes = dict()
+                for converter in self.converters:
+                    if not converter.includes(book, sheet):
+                        continue
+                    lines = converter.selected_lines(sheet)
+                    if not converter.begin_sheet(book, sheet, lines):
+                        active.append(converter)
+                        for line in lines:
+                            routes.setdefault(line, []).append(converter)
+                for line in sorted(routes):
+                    count += 1
+                    yield book.base_name, sheet.name, count
+                    for converter in routes[line]:
+                        converter.render_line(sheet, line)
+                for converter in active:
+                    converter.stop_recording()
+        for converter in self.converters:
+            converter.footer()
+
 
 requirements_ru = """
 
@@ -547,7 +1975,7 @@ requirements_ru = """
 
 Требования к формату файла MS Excel:
 
-- Формат файла MS Excel xls. (xlsx не поддерживается!)
+- Формат файла MS Excel xls или xlsx.
 - Предметная информация размещается в листах, начиная со второго (первый
   игнорируется конвертором)
 - Разбиение на листы — только для удобства. Конвертер проходит по ним
@@ -569,7 +1997,7 @@ description='Convert RFP MS Excel file to MS Word'
 
 requirements_en = """MS Excel file format requirements:
 
-— MS Excel file should be xls and not xlsx
+— MS Excel file should be xls or xlsx
 — Excel book sheets are processed starting from second one (first sheet is ignored by converter)
 — Splitting list of requirements to separate sheets is only for convenience. Converter processes them from left to right consecutively
 — First column on each sheet is reserved for converter parameters
@@ -583,6 +2011,25 @@ requirements_en = """MS Excel file format requirements:
 """
 
 
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def positive_int(value: str) -> int:
+    result = int(value)
+    if result < 1:
+        raise ValueError(value)
+    return result
+
+
+def source_date():
+    """ return build date from SOURCE_DATE_EPOCH environment variable or None """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if not epoch:
+        return None
+    return datetime.fromtimestamp(int(epoch), timezone.utc).date()
+
+
 def parse_args():
     import argparse
     parser = argparse.ArgumentParser(description=description,
@@ -590,17 +2037,54 @@ def parse_args():
                                      formatter_class = argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument('-f', '--format',
-                        choices=[ExcelToWordList.name,
-                                 ExcelToWordPlainTable.name,
-                                 ExcelToWordTable.name],
+                        choices=list(available_converters),
                         help='Output file format')
-    parser.add_argument("files", nargs='+', help="xls filename to convert")
+    parser.add_argument('-t', '--template',
+                        help='docx file to use as template for output')
+    parser.add_argument('--chunk-level', type=int, metavar='LEVEL',
+                        help='Start new table at every heading of this level or higher '
+                             '(table formats only)')
+    parser.add_argument('--chunk-rows', type=int, metavar='N',
+                        help='Start new table after every N rows (table formats only)')
+    parser.add_argument('--volumes', choices=volume_modes,
+                        help='Split output into volume documents by workbook, sheet, '
+                             'number of rows or size')
+    parser.add_argument('--volume-budget', type=int, metavar='N',
+                        help='Rows or approximate bytes per volume for rows and size modes')
+    parser.add_argument('-j', '--jobs', type=positive_int,
+                        help='Number of worker processes parsing workbooks, prerendering '
+                             'sheets and rendering volumes (default: number of CPUs)')
+    parser.add_argument('--build-date', type=parse_date, default=source_date(),
+                        metavar='YYYY-MM-DD',
+                        help='Date to put into output instead of today, makes output '
+                             'reproducible (default: SOURCE_DATE_EPOCH if set)')
+    parser.add_argument('-c', '--criteria', metavar='EXPRESSION',
+                        help='Convert only rows selected by criteria expression, e.g. '
+                             '"SPE and not (DDAN or TMCM)". Operators are AND, OR, NOT '
+                             'and parentheses, names with operator words can be quoted')
+    parser.add_argument('--target', action='append', metavar='FORMAT[:CRITERIA[:SHEETS]]',
+                        help='Output to produce, CRITERIA is expression or comma separated '
+                             'names any of which selects row (default: --criteria), SHEETS '
+                             'are comma separated. Repeat to produce several outputs from '
+                             'one pass over input')
+    parser.add_argument('--force', action='store_true',
+                        help='Convert even if output is up to date with its manifest')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use cache of parsed workbooks')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Load workbook sheets one at a time to keep memory usage low')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='Keep parsed rows in memory up to MB megabytes, '
+                             'spill the rest to a temporary file')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Write output incrementally to keep memory usage flat')
+    parser.add_argument("files", nargs='+', help="xls or xlsx filename to convert")
     return parser.parse_args()
 
 
-def output_file_name(input_file_name, folder=''):
+def output_file_name(input_file_name, folder='', day: date=None):
     name, ext = os.path.splitext(input_file_name)
-    today = strftime('%d%m%Y')
+    today = (day or date.today()).strftime('%d%m%Y')
     return os.path.join(folder, '{}_{}.docx'.format(name, today))
 
 
@@ -627,25 +2111,106 @@ def convert(converter):
                     print('done\n%s: %s' % (current_phase, spin.placeholder()), end='')
                 spin()
     print('Total number of requirements: {}'.format(converter.count_requirements))
+    for line in converter.report():
+        print(line)
     print('Output written to: {}'.format(output_file_name_docx))
 
 
 available_converters = {
     ExcelToWordTable.name: ExcelToWordTable,
     ExcelToWordPlainTable.name: ExcelToWordPlainTable,
-    ExcelToWordList.name: ExcelToWordList
+    ExcelToWordList.name: ExcelToWordList,
+    ExcelToWordCompactTable.name: ExcelToWordCompactTable,
+    ExcelToWordCompactPlainTable.name: ExcelToWordCompactPlainTable,
 }
 
 default_converter = ExcelToWordList
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     args = parse_args()
-    output_file_name_docx = output_file_name(args.files[0])
+    output_file_name_docx = output_file_name(args.files[0], day=args.build_date)
     try:
         converter_class = available_converters[args.format]
     except KeyError:
         converter_class = ExcelToWordList
 
-    converter = converter_class(args.files, output_file_name_docx)
+    options = dict(stream=args.stream, template=args.template,
+                   use_cache=not args.no_cache, build_date=args.build_date, lazy=args.lazy,
+                   memory_budget=None if args.memory_budget is None
+                   else int(args.memory_budget * 1024 * 1024),
+                   criteria=args.criteria or [])
+    # Criteria names of headers, unknown names in expressions would select nothing
+    packages = list_packages(args.files) if args.criteria or args.target else None
+    try:
+        selection.parse(args.criteria, packages)
+    except RuntimeError as e:
+        sys.exit(e)
+    if args.chunk_level is not None or args.chunk_rows is not None:
+        if not args.target and not issubclass(converter_class, ExcelToWordTable):
+            sys.exit('--chunk-level and --chunk-rows are supported by table formats only')
+        options.update(chunk_level=args.chunk_level, chunk_rows=args.chunk_rows)
+    if args.target and args.volumes:
+        sys.exit('--target and --volumes can not be used together')
+    if args.volume_budget is not None:
+        if args.volumes not in ('rows', 'size'):
+            sys.exit('--volume-budget is used with --volumes rows or size only')
+        if args.volume_budget < 1:
+            sys.exit('--volume-budget must be a positive number')
+    elif args.volumes in ('rows', 'size'):
+        sys.exit('--volumes {} requires --volume-budget'.format(args.volumes))
+    if args.volumes:
+        with timer():
+            volumes = convert_volumes(converter_class, args.files, output_file_name_docx,
+                                      args.volumes, budget=args.volume_budget,
+                                      jobs=args.jobs, force=args.force, **options)
+        for file_name, volume, count, rebuilt in volumes:
+            print('{}: {} sheets, {} requirements{}'.format(
+                file_name, len(volume), count, '' if rebuilt else ' (up to date)'))
+        rebuilt = sum(1 for volume in volumes if volume[3])
+        print('Volumes rebuilt: {}, skipped: {}'.format(rebuilt, len(volumes) - rebuilt))
+        print('Index written to: {}'.format(index_file_name(output_file_name_docx)))
+        sys.exit(0)
+    if args.target:
+        default_criteria = options.pop('criteria')
+        targets = []
+        skipped = []
+        for spec in args.target:
+            format, criteria, sheets = (spec.split(':', 2) + ['', ''])[:3]
+            if format not in available_converters:
+                sys.exit('{}: unknown format in --target {}'.format(format, spec))
+            if ',' in criteria:
+                criteria = [name for name in criteria.split(',') if name]
+            else:
+                criteria = criteria.strip() or default_criteria
+            try:
+                selection.parse(criteria, packages)
+            except RuntimeError as e:
+                sys.exit(e)
+            sheets = [name for name in sheets.split(',') if name]
+            file_name = target_file_name(output_file_name_docx, format, criteria, sheets)
+            if not args.force and up_to_date(file_name, conversion_manifest(
+                    format, args.files, criteria=criteria, sheets=sheets,
+                    **FanOut.converter_options(available_converters[format], options))):
+                skipped.append(file_name)
+                continue
+            targets.append((criteria, sheets, format, file_name))
+        if targets:
+            with timer():
+                fan_out = FanOut(args.files, targets, jobs=args.jobs, **options)
+                for _ in fan_out.run():
+                    pass
+            for converter in fan_out.converters:
+                print('{}: {} requirements'.format(converter.file_name_docx,
+                                                   converter.count_requirements))
+        for file_name in skipped:
+            print('{}: up to date'.format(file_name))
+        print('Outputs rebuilt: {}, skipped: {}'.format(len(targets), len(skipped)))
+        sys.exit(0)
+    if not args.force and up_to_date(output_file_name_docx, conversion_manifest(
+            converter_class.name, args.files, **options)):
+        print('Output is up to date: {}'.format(output_file_name_docx))
+        sys.exit(0)
+    converter = converter_class(args.files, output_file_name_docx, jobs=args.jobs, **options)
     print(converter.list_packages())
     convert(converter)